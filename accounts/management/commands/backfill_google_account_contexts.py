@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import CompanyProfile
+from accounts.tasks import refresh_google_account_context
+
+
+class Command(BaseCommand):
+    help = ("Fetch the Google account of linked profiles that never had it fetched, such as the ones linked "
+            "before the account was stored. Run once after deploying instead of waiting for the nightly refresh.")
+
+    def handle(self, *args, **options):
+        profile_ids = list(CompanyProfile.objects.filter(
+            google_credentials__isnull=False, google_account_refreshed_at__isnull=True,
+        ).order_by('id').values_list('id', flat=True))
+        failed = 0
+        for profile_id in profile_ids:
+            try:
+                refresh_google_account_context(profile_id)
+            except Exception as e:
+                # Left for the nightly refresh, which retries profiles that were never fetched
+                failed += 1
+                self.stderr.write(f'profile {profile_id}: {e}')
+        self.stdout.write(f'refreshed {len(profile_ids) - failed} of {len(profile_ids)} profiles')
@@ -1,5 +1,5 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.http import HttpRequest
@@ -122,6 +122,75 @@ class CompanyProfile(models.Model):
     should_input_citizen_id = models.BooleanField(default=True)
     should_input_phone = models.BooleanField(default=True)
     subscription_id = models.CharField(max_length=100,null=True, blank=True)
+    # Google account of google_credentials, kept by accounts.tasks.refresh_google_account_context
+    google_account_name = models.CharField(max_length=200, blank=True, default='')
+    google_account_email = models.CharField(max_length=200, blank=True, default='')
+    google_account_picture = models.URLField(max_length=500, blank=True, default='')
+    google_account_refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    # MercadoPago subscription_id, kept by accounts.tasks.sync_subscription
+    subscription_status = models.CharField(max_length=30, blank=True, default='')
+    subscription_reason = models.CharField(max_length=255, blank=True, default='')
+    subscription_date_created = models.DateTimeField(null=True, blank=True)
+    subscription_next_payment_date = models.DateTimeField(null=True, blank=True)
+    subscription_synced_at = models.DateTimeField(null=True, blank=True)
+
+    GOOGLE_ACCOUNT_FIELDS = ['google_account_name', 'google_account_email', 'google_account_picture',
+                             'google_account_refreshed_at']
+    SUBSCRIPTION_FIELDS = ['subscription_status', 'subscription_reason', 'subscription_date_created',
+                           'subscription_next_payment_date', 'subscription_synced_at']
+
+    def get_google_account_context(self):
+        if not self.google_credentials or not self.google_account_refreshed_at:
+            return None
+        return {
+            'name': self.google_account_name,
+            'picture': self.google_account_picture,
+            'email': self.google_account_email,
+        }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Keep the stored subscription so save() can tell when another one is linked
+        instance._loaded_subscription_id = dict(zip(field_names, values)).get('subscription_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        changed = (update_fields is None or 'subscription_id' in update_fields) and (
+            self._state.adding or hasattr(self, '_loaded_subscription_id')
+        ) and self.subscription_id != getattr(self, '_loaded_subscription_id', None)
+        if changed:
+            # The mirror describes the previous subscription until the new one is synced
+            for field in self.SUBSCRIPTION_FIELDS:
+                setattr(self, field, self._meta.get_field(field).get_default())
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *self.SUBSCRIPTION_FIELDS}
+        super().save(*args, **kwargs)
+        self._loaded_subscription_id = self.subscription_id
+        if changed and self.subscription_id:
+            # Imported here as accounts.tasks imports this module
+            from accounts.tasks import sync_subscription
+            subscription_id = self.subscription_id
+            transaction.on_commit(lambda: sync_subscription.delay(subscription_id))
+
+    def get_subscription(self):
+        if not self.subscription_id or not self.subscription_synced_at:
+            return None
+        return {
+            'status': self.subscription_status,
+            'reason': self.subscription_reason,
+            'date_created': self.subscription_date_created,
+            'next_payment_date': self.subscription_next_payment_date,
+        }
+
+    def clear_google_account(self):
+        self.google_account_name = ''
+        self.google_account_email = ''
+        self.google_account_picture = ''
+        self.google_account_refreshed_at = None
+
     def get_fields(self):
         fields = {
             'Nombre': self.name,
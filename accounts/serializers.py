@@ -1,14 +1,8 @@
-import mercadopago
 from django.contrib.auth.hashers import make_password
-from google.auth.exceptions import RefreshError
-from google.auth.transport import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from rest_framework import serializers
 from rest_framework.permissions import AllowAny
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
-from app import settings
 from .models import *
 
 
@@ -36,56 +30,25 @@ class CompanyProfileSerializer(serializers.ModelSerializer):
     google_account_context = serializers.SerializerMethodField()
 
     def get_subscription(self, obj):
-        sdk = mercadopago.SDK(settings.MERCADO_PAGO_ACCESS_TOKEN)
-        subscription_id = obj.subscription_id
-
-        if not subscription_id:
+        # Mirrored by accounts.tasks.sync_subscription, never fetched while serializing
+        subscription = obj.get_subscription()
+        if subscription is None:
             return None
-        subscription = sdk.subscription().get(obj.subscription_id)['response']
-        print(subscription)
-        return {
-            "status": subscription['status'],
-            "reason": subscription['reason'],
-            "date_created": subscription['date_created'],
-            "next_payment_date": subscription['next_payment_date'],
-        }
+        for field in ['date_created', 'next_payment_date']:
+            if subscription[field]:
+                subscription[field] = serializers.DateTimeField().to_representation(subscription[field])
+        return subscription
 
     def get_has_google_account_linked(self, obj):
         return obj.google_credentials != None
 
     def get_google_account_context(self, obj):
-        user_credentials = obj.google_credentials
-        if user_credentials:
-            try:
-                creds = Credentials(
-                    **user_credentials
-                )
-                if creds.expired and creds.refresh_token:
-                        creds.refresh(Request())
-
-                service = build('people', 'v1', credentials=creds)
-                profile = service.people().get(resourceName='people/me', personFields='names,emailAddresses,photos'
-                                                ).execute()
-                name = profile['names'][0]['displayName']
-                photo = profile['photos'][0]['url']
-                email = profile['emailAddresses'][0]['value']
-
-                context = {
-                    'name': name,
-                    'picture': photo,
-                    'email': email,
-                }
-                return context
-            except RefreshError as e:
-                obj.google_credentials = None
-                obj.save()
-                return None
-        else:
-            return None
+        # Stored by accounts.tasks.refresh_google_account_context, never fetched while serializing
+        return obj.get_google_account_context()
 
     class Meta:
         model = CompanyProfile
-        fields = "__all__"
+        exclude = CompanyProfile.GOOGLE_ACCOUNT_FIELDS + CompanyProfile.SUBSCRIPTION_FIELDS
 
 
 class ChangePasswordSerializer(serializers.Serializer):
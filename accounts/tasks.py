@@ -0,0 +1,86 @@
+from celery import shared_task
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from accounts.models import CompanyProfile
+from accounts.subscriptions import apply_subscription, mercadopago_sdk
+
+
+def fetch_google_account(credentials: dict) -> dict:
+    # Name, email and photo of the linked account from the People API
+    creds = Credentials(**credentials)
+    if creds.expired and creds.refresh_token:
+        creds.refresh(Request())
+    service = build('people', 'v1', credentials=creds)
+    profile = service.people().get(resourceName='people/me', personFields='names,emailAddresses,photos').execute()
+    return {
+        'google_account_name': profile['names'][0]['displayName'],
+        'google_account_picture': profile['photos'][0]['url'],
+        'google_account_email': profile['emailAddresses'][0]['value'],
+    }
+
+
+@shared_task
+def refresh_google_account_context(company_profile_id):
+    profile = CompanyProfile.objects.filter(pk=company_profile_id).first()
+    if profile is None:
+        return
+    if not profile.google_credentials:
+        profile.clear_google_account()
+        profile.save(update_fields=CompanyProfile.GOOGLE_ACCOUNT_FIELDS)
+        return
+    try:
+        account = fetch_google_account(profile.google_credentials)
+    except RefreshError:
+        # The grant was revoked or expired, so the account is unlinked
+        profile.google_credentials = None
+        profile.clear_google_account()
+        profile.save(update_fields=['google_credentials', *CompanyProfile.GOOGLE_ACCOUNT_FIELDS])
+        return
+    for field, value in account.items():
+        setattr(profile, field, value)
+    profile.google_account_refreshed_at = timezone.now()
+    profile.save(update_fields=CompanyProfile.GOOGLE_ACCOUNT_FIELDS)
+
+
+@shared_task
+def refresh_google_account_contexts():
+    # Linked profiles whose account was never fetched or is older than GOOGLE_ACCOUNT_CONTEXT_TTL
+    stale = timezone.now() - settings.GOOGLE_ACCOUNT_CONTEXT_TTL
+    profile_ids = list(CompanyProfile.objects.filter(
+        Q(google_account_refreshed_at__isnull=True) | Q(google_account_refreshed_at__lt=stale),
+        google_credentials__isnull=False,
+    ).values_list('id', flat=True))
+    for profile_id in profile_ids:
+        refresh_google_account_context.delay(profile_id)
+    return len(profile_ids)
+
+
+@shared_task
+def sync_subscription(subscription_id):
+    # Mirror a MercadoPago subscription onto the profiles that hold it
+    profiles = list(CompanyProfile.objects.filter(subscription_id=subscription_id))
+    if not profiles:
+        return
+    response = mercadopago_sdk().subscription().get(subscription_id)
+    if response['status'] != 200:
+        raise RuntimeError(f"MercadoPago answered {response['status']} for subscription {subscription_id}")
+    for profile in profiles:
+        apply_subscription(profile, response['response'])
+        profile.save(update_fields=CompanyProfile.SUBSCRIPTION_FIELDS)
+    return response['response'].get('status')
+
+
+@shared_task
+def reconcile_subscriptions():
+    # Catches up on webhook notifications that never arrived
+    subscription_ids = list(CompanyProfile.objects.exclude(subscription_id__isnull=True).exclude(
+        subscription_id='').values_list('subscription_id', flat=True).distinct())
+    for subscription_id in subscription_ids:
+        sync_subscription.delay(subscription_id)
+    return len(subscription_ids)
@@ -1 +1,190 @@
-# Create your tests here.
+from unittest import mock
+
+import hashlib
+import hmac
+import io
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from google.auth.exceptions import RefreshError
+from rest_framework.test import APIClient
+
+from appointments.models import OutboxMessage
+from .models import Company, CompanyProfile
+from .serializers import CompanyProfileSerializer
+from .tasks import reconcile_subscriptions, refresh_google_account_context, sync_subscription
+
+CREDENTIALS = {'token': 'token', 'refresh_token': 'refresh', 'token_uri': 'https://oauth2.googleapis.com/token',
+               'client_id': 'client', 'client_secret': 'secret', 'scopes': []}
+PERSON = {
+    'names': [{'displayName': 'Company Test'}],
+    'photos': [{'url': 'https://example.com/photo.png'}],
+    'emailAddresses': [{'value': 'google@example.com'}],
+}
+
+
+class GoogleAccountContextTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create_user(email='company@example.com', first_name='Company', last_name='Test')
+        cls.profile = CompanyProfile.objects.create(company=company, name='Company', address='Main', phone='0',
+                                                    slug='company', google_credentials=CREDENTIALS)
+
+    @mock.patch('accounts.tasks.build')
+    def test_refresh_stores_the_account(self, build):
+        build.return_value.people.return_value.get.return_value.execute.return_value = PERSON
+        self.assertIsNone(CompanyProfileSerializer(self.profile).data['google_account_context'])
+
+        refresh_google_account_context(self.profile.id)
+        self.profile.refresh_from_db()
+        build.return_value.people.return_value.get.assert_called_once_with(
+            resourceName='people/me', personFields='names,emailAddresses,photos')
+        with mock.patch('googleapiclient.discovery.build', side_effect=AssertionError), self.assertNumQueries(0):
+            data = CompanyProfileSerializer(self.profile).data
+        self.assertEqual(data['google_account_context'], {
+            'name': 'Company Test', 'picture': 'https://example.com/photo.png', 'email': 'google@example.com',
+        })
+        self.assertNotIn('google_account_name', data)
+
+    @mock.patch('accounts.tasks.fetch_google_account', side_effect=RefreshError)
+    def test_revoked_grant_unlinks_the_account(self, fetch_google_account):
+        refresh_google_account_context(self.profile.id)
+        self.profile.refresh_from_db()
+        self.assertIsNone(self.profile.google_credentials)
+        self.assertIsNone(CompanyProfileSerializer(self.profile).data['google_account_context'])
+
+
+    @mock.patch('accounts.tasks.fetch_google_account')
+    def test_backfill_fetches_profiles_linked_before(self, fetch_google_account):
+        account = {'google_account_name': 'Company Test', 'google_account_picture': 'https://example.com/photo.png',
+                   'google_account_email': 'google@example.com'}
+        fetch_google_account.side_effect = [ConnectionError('unreachable'), account]
+        company = Company.objects.create_user(email='other@example.com', first_name='Other', last_name='Test')
+        other = CompanyProfile.objects.create(company=company, name='Other', address='Main', phone='0',
+                                              slug='other', google_credentials=CREDENTIALS)
+        company = Company.objects.create_user(email='unlinked@example.com', first_name='Unlinked', last_name='Test')
+        CompanyProfile.objects.create(company=company, name='Unlinked', address='Main', phone='0', slug='unlinked')
+
+        # A failure does not stop the profiles after it
+        stdout = io.StringIO()
+        call_command('backfill_google_account_contexts', stdout=stdout, stderr=io.StringIO())
+        self.assertIn('refreshed 1 of 2 profiles', stdout.getvalue())
+        other.refresh_from_db()
+        self.assertEqual(other.get_google_account_context()['email'], 'google@example.com')
+
+        # Only the profile that failed is left
+        fetch_google_account.side_effect = [account]
+        call_command('backfill_google_account_contexts', stdout=io.StringIO())
+        self.assertEqual(fetch_google_account.call_count, 3)
+        self.profile.refresh_from_db()
+        self.assertIsNotNone(self.profile.get_google_account_context())
+
+class FakeSubscriptions:
+    def __init__(self, subscriptions: dict):
+        self.subscriptions = subscriptions
+        self.requested = []
+
+    def get(self, subscription_id):
+        self.requested.append(subscription_id)
+        if subscription_id not in self.subscriptions:
+            return {'status': 404, 'response': {'message': 'not found'}}
+        return {'status': 200, 'response': self.subscriptions[subscription_id]}
+
+
+class FakeSDK:
+    # Stand-in for mercadopago.SDK with the subscription().get the sync uses
+    def __init__(self, subscriptions: dict):
+        self.subscriptions = FakeSubscriptions(subscriptions)
+
+    def subscription(self):
+        return self.subscriptions
+
+
+class SubscriptionMirrorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create_user(email='company@example.com', first_name='Company', last_name='Test')
+        cls.profile = CompanyProfile.objects.create(company=company, name='Company', address='Main', phone='0',
+                                                    slug='company', subscription_id='sub-1')
+
+    def setUp(self):
+        self.sdk = FakeSDK({'sub-1': {
+            'id': 'sub-1', 'status': 'authorized', 'reason': 'Denti - Plan profesional',
+            'date_created': '2024-05-01T10:00:00.000-04:00', 'next_payment_date': '2024-06-01T10:00:00.000-04:00',
+        }})
+        patcher = mock.patch('accounts.tasks.mercadopago_sdk', return_value=self.sdk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_serializer_reads_the_mirrored_subscription(self):
+        self.assertIsNone(CompanyProfileSerializer(self.profile).data['subscription'])
+
+        self.assertEqual(sync_subscription('sub-1'), 'authorized')
+        self.profile.refresh_from_db()
+        with mock.patch('mercadopago.SDK', side_effect=AssertionError), self.assertNumQueries(0):
+            data = CompanyProfileSerializer(self.profile).data
+        self.assertEqual(data['subscription'], {
+            'status': 'authorized',
+            'reason': 'Denti - Plan profesional',
+            'date_created': '2024-05-01T09:00:00-05:00',
+            'next_payment_date': '2024-06-01T09:00:00-05:00',
+        })
+        self.assertNotIn('subscription_status', data)
+
+    def test_webhook_enqueues_a_sync_of_known_subscriptions(self):
+        client = APIClient()
+        for body, enqueued in [
+            ({'type': 'subscription_preapproval', 'action': 'updated', 'data': {'id': 'sub-1'}}, True),
+            ({'type': 'subscription_preapproval', 'action': 'updated', 'data': {'id': 'unknown'}}, False),
+            ({'type': 'payment', 'action': 'payment.created', 'data': {'id': 'sub-1'}}, False),
+        ]:
+            OutboxMessage.objects.all().delete()
+            with self.subTest(body=body):
+                response = client.post('/api/mercadopago_webhook/', body, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')),
+                                 [('accounts.tasks.sync_subscription', ['sub-1'])] if enqueued else [])
+        self.assertEqual(self.sdk.subscriptions.requested, [])
+
+    @override_settings(MERCADO_PAGO_WEBHOOK_SECRET='secret')
+    def test_webhook_checks_the_signature(self):
+        client = APIClient()
+        body = {'type': 'subscription_preapproval', 'data': {'id': 'sub-1'}}
+        signature = hmac.new(b'secret', b'id:sub-1;request-id:request;ts:1700000000;', hashlib.sha256).hexdigest()
+        response = client.post('/api/mercadopago_webhook/', body, format='json', headers={
+            'x-signature': 'ts=1700000000,v1=forged', 'x-request-id': 'request'})
+        self.assertEqual(response.status_code, 403)
+        response = client.post('/api/mercadopago_webhook/', body, format='json', headers={
+            'x-signature': f'ts=1700000000,v1={signature}', 'x-request-id': 'request'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    def test_reconcile_syncs_every_subscription(self):
+        with mock.patch('accounts.tasks.sync_subscription.delay') as delay:
+            self.assertEqual(reconcile_subscriptions(), 1)
+        delay.assert_called_once_with('sub-1')
+
+        CompanyProfile.objects.filter(pk=self.profile.pk).update(subscription_id='gone')
+        with self.assertRaises(RuntimeError):
+            sync_subscription('gone')
+
+    def test_linking_another_subscription_resets_the_mirror_and_syncs_it(self):
+        sync_subscription('sub-1')
+        profile = CompanyProfile.objects.get(pk=self.profile.pk)
+        self.sdk.subscriptions.subscriptions['sub-2'] = {'id': 'sub-2', 'status': 'pending', 'reason': 'Denti'}
+        with mock.patch('accounts.tasks.sync_subscription.delay', side_effect=sync_subscription) as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                profile.subscription_id = 'sub-2'
+                profile.save()
+                self.assertIsNone(CompanyProfileSerializer(profile).data['subscription'])
+                self.assertEqual(delay.call_count, 0)
+            delay.assert_called_once_with('sub-2')
+            profile.refresh_from_db()
+            self.assertEqual(profile.get_subscription()['status'], 'pending')
+
+            # Saving other fields leaves the mirror alone
+            with self.captureOnCommitCallbacks(execute=True):
+                profile.name = 'Renamed'
+                profile.save()
+            self.assertEqual(delay.call_count, 1)
+        self.assertEqual(CompanyProfile.objects.get(pk=profile.pk).subscription_status, 'pending')
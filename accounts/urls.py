@@ -15,6 +15,7 @@ router.register(r'company-profiles', CompanyProfileViewSet)
 
 urlpatterns = [
     path('google_auth_callback/', GoogleAuthCallback.as_view(), name='google-auth-callback'),
+    path('mercadopago_webhook/', MercadoPagoWebhookView.as_view(), name='mercadopago-webhook'),
     path('google_auth_login/', GoogleAuthLogin.as_view(), name='google-auth-login'),
     path('google_auth_revoke/', GoogleAuthRevoke.as_view(), name='google-auth-revoke'),
     path('change_password/', ChangePasswordView.as_view(), name='change-password'),
@@ -20,8 +20,12 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
 from app.settings import CLIENT_CONFIG, GOOGLE_SCOPES, BACKEND_SITE_URL, FRONTEND_SITE_URL
+from appointments.catalog import CatalogConditionalGetMixin, slug_company_id
+from appointments.outbox import enqueue
 from .models import *
 from .serializers import *
+from .subscriptions import SUBSCRIPTION_TOPICS, valid_webhook_signature
+from .tasks import refresh_google_account_context, sync_subscription
 
 
 class GoogleAuthCallback(APIView):
@@ -60,6 +64,7 @@ class GoogleAuthCallback(APIView):
             created_calendar = service.calendars().insert(body=calendar).execute()
             company.companyprofile.calendar_id = created_calendar['id']
             company.companyprofile.save()
+            enqueue(refresh_google_account_context, (company.companyprofile.id,))
             messages.success(request, 'Conexión con Google exitosa')
         except Exception as e:
             messages.error(request,
@@ -79,6 +84,7 @@ class GoogleAuthRevoke(APIView):
 
         company.companyprofile.google_credentials = None
         company.companyprofile.calendar_id = None
+        company.companyprofile.clear_google_account()
         company.companyprofile.save()
         return Response(status=status.HTTP_200_OK)
 
@@ -120,12 +126,18 @@ class CompanyViewSet(ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class CompanyProfileViewSet(ModelViewSet):
+class CompanyProfileViewSet(CatalogConditionalGetMixin, ModelViewSet):
     queryset = CompanyProfile.objects.all()
     serializer_class = CompanyProfileSerializer
     permission_classes = [permissions.AllowAny] #todo: change to IsAuthenticated and use SimpleCompanyProfileView instead
     filterset_fields = ['company', "slug"]
 
+    def get_catalog_company_id(self):
+        slug = self.request.query_params.get('slug')
+        if slug and 'company' not in self.request.query_params:
+            return slug_company_id(slug)
+        return super().get_catalog_company_id()
+
     def partial_update(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=True)
@@ -134,6 +146,26 @@ class CompanyProfileViewSet(ModelViewSet):
         serializer.save()
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+class MercadoPagoWebhookView(APIView):
+    # Notifications only name the subscription that changed; sync_subscription fetches its state
+    permission_classes = [permissions.AllowAny]
+    authentication_classes = []
+
+    def post(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        topic = data.get('type') or request.query_params.get('type') or request.query_params.get('topic')
+        subscription_id = (data.get('data') or {}).get('id') or request.query_params.get('data.id') \
+            or request.query_params.get('id')
+        # Other topics are acknowledged too, so that MercadoPago does not retry them
+        if topic not in SUBSCRIPTION_TOPICS or not subscription_id:
+            return Response(status=status.HTTP_200_OK)
+        if not valid_webhook_signature(request, str(subscription_id)):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        if CompanyProfile.objects.filter(subscription_id=subscription_id).exists():
+            enqueue(sync_subscription, (str(subscription_id),))
+        return Response(status=status.HTTP_200_OK)
+
+
 class CustomerViewSet(viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
@@ -0,0 +1,55 @@
+import time
+
+from django.core.cache import cache
+
+
+def _initial_version() -> int:
+    # Seeded from the clock so that a version evicted from the cache never
+    # comes back with a number that older entries were stored under.
+    return int(time.time() * 1000)
+
+
+def get_version(name: str) -> int:
+    return cache.get_or_set(f'version:{name}', _initial_version, timeout=None)
+
+
+def bump_version(name: str) -> int:
+    key = f'version:{name}'
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+class HitCounter:
+    def __init__(self, name: str):
+        self.name = name
+
+    def _key(self, kind: str) -> str:
+        return f'counter:{self.name}:{kind}'
+
+    def _incr(self, kind: str):
+        try:
+            cache.incr(self._key(kind))
+        except ValueError:
+            cache.add(self._key(kind), 0, timeout=None)
+            cache.incr(self._key(kind))
+
+    def hit(self):
+        self._incr('hits')
+
+    def miss(self):
+        self._incr('misses')
+
+    def stats(self) -> dict:
+        values = cache.get_many([self._key('hits'), self._key('misses')])
+        hits = values.get(self._key('hits'), 0)
+        misses = values.get(self._key('misses'), 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else None,
+        }
@@ -0,0 +1,30 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# int, float, bool and None keys become strings as json.dumps writes them, and UTC datetimes end in Z
+# as JSONEncoder writes them
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+class ORJSONRenderer(JSONRenderer):
+    # JSONRenderer output through orjson. Datetimes, dates and times are encoded natively;
+    # timedeltas, Decimals, lazy strings and the rest fall back to DRF's JSONEncoder.
+    # Where the output differs from JSONRenderer: orjson only indents by 2, writes float exponents
+    # without sign or padding (1e16 and 1.5e-7 rather than 1e+16 and 1.5e-07), and renders date
+    # and other non-string keys as strings where JSONRenderer raises.
+    default = staticmethod(JSONEncoder().default)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact:
+            # orjson only writes compact UTF-8, so UNICODE_JSON and COMPACT_JSON off are left to JSONRenderer
+            return super().render(data, accepted_media_type, renderer_context)
+
+        options = OPTIONS
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            options |= orjson.OPT_INDENT_2
+        ret = orjson.dumps(data, default=self.default, option=options)
+        # Same escaping as JSONRenderer, so that the output stays a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
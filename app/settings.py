@@ -15,6 +15,9 @@ from datetime import timedelta
 from pathlib import Path
 
 import environ
+from celery.schedules import crontab
+from corsheaders.defaults import default_headers
+from django.core.exceptions import ImproperlyConfigured
 
 env = environ.Env()
 
@@ -108,6 +111,21 @@ DATABASES = {
     }
 }
 
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # SQLite ignores select_for_update, so take the write lock when the transaction starts
+    DATABASES['default']['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+
+# Cache
+# Set CACHE_URL (e.g. redis://127.0.0.1:6379/1) so that every worker shares
+# the same availability cache and version counters. A per-process locmem cache
+# is only a fallback for development: with several workers each one would keep
+# its own versions and serve data another worker already invalidated.
+if 'CACHE_URL' not in env and not DEBUG:
+    raise ImproperlyConfigured("Set CACHE_URL to a cache shared by every worker, e.g. redis://127.0.0.1:6379/1")
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 """
@@ -207,6 +225,15 @@ REST_FRAMEWORK = {
         "rest_framework.authentication.SessionAuthentication",
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
+    'DEFAULT_RENDERER_CLASSES': [
+        'app.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'app.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'PAGE_SIZE': 100
 }
 
@@ -221,6 +248,10 @@ CORS_ORIGIN_ALLOW_ALL = True
 #    "https://localhost:5173"
 #]
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (
+    *default_headers,
+    'idempotency-key',
+)
 
 # CRONTAB_PYTHON_EXECUTABLE = f'{BASE_DIR}/venv/bin/python3'
 
@@ -230,6 +261,8 @@ CRONJOBS = [
 
 MERCADO_PAGO_PLAN_ID = env('MERCADO_PAGO_PLAN_ID')
 MERCADO_PAGO_ACCESS_TOKEN = env('MERCADO_PAGO_ACCESS_TOKEN')
+# Secret of the webhook notifications, checked against their x-signature header when set
+MERCADO_PAGO_WEBHOOK_SECRET = env('MERCADO_PAGO_WEBHOOK_SECRET', default='')
 
 CELERY_BROKER_URL = "amqp://"
 CELERY_ACCEPT_CONTENT = ['json']
@@ -237,6 +270,36 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Bogota'
 CELERY_RESULT_BACKEND = 'django-db'
+CELERY_BEAT_SCHEDULE = {
+    'relay-outbox': {
+        'task': 'appointments.tasks.relay_outbox',
+        'schedule': 5.0,
+    },
+    'purge-outbox': {
+        'task': 'appointments.tasks.purge_outbox',
+        'schedule': crontab(minute=30, hour=3),
+    },
+    'purge-idempotency-keys': {
+        'task': 'appointments.tasks.purge_idempotency_keys',
+        'schedule': crontab(minute=0, hour=3),
+    },
+    'refresh-google-account-contexts': {
+        'task': 'accounts.tasks.refresh_google_account_contexts',
+        'schedule': crontab(minute=0, hour=4),
+    },
+    'reconcile-subscriptions': {
+        'task': 'accounts.tasks.reconcile_subscriptions',
+        'schedule': crontab(minute=30, hour=4),
+    },
+}
+
+# Replays of POST new_appointment/ with the same Idempotency-Key within this window
+# get the stored response back
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
+# Google account name, email and photo shown in company profiles are fetched again after this
+GOOGLE_ACCOUNT_CONTEXT_TTL = timedelta(days=1)
 
 #celery -A app worker -l INFO -P gevent
+#celery -A app beat -l INFO
 #python manage.py runserver_plus --cert-file cert.pem --key-file key.pem
\ No newline at end of file
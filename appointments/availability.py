@@ -0,0 +1,243 @@
+import datetime as dt
+from array import array
+from collections import defaultdict
+
+import pytz
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from app.cache import HitCounter, bump_version, get_version
+from .models import Appointment, Service, overlapping
+from .schedule import get_schedule_template, to_seconds
+
+SECONDS_PER_DAY = 24 * 60 * 60
+AVAILABILITY_CACHE_TIMEOUT = 60 * 60 * 24
+NEXT_AVAILABLE_CHUNK_DAYS = 14
+
+availability_counter = HitCounter('availability')
+
+
+def from_seconds(seconds: int) -> dt.time:
+    return dt.time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def merge_intervals(intervals) -> list:
+    # Sort once and fold overlapping or touching intervals together
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def free_slots(slots, busy, duration: int) -> list:
+    # Single sweep over sorted slots and merged busy intervals: a slot is taken when
+    # [slot, slot + duration) overlaps a busy interval, the check booking applies.
+    # Only the first interval ending after the slot can overlap it, as the rest start later.
+    free = []
+    busy = iter(busy)
+    current = next(busy, None)
+    for slot in slots:
+        while current is not None and current[1] <= slot:
+            current = next(busy, None)
+        if current is None or slot + duration <= current[0]:
+            free.append(slot)
+    return free
+
+
+def duration_seconds(template) -> int:
+    return int(template.duration.total_seconds())
+
+
+def busy_intervals_by_date(appointments) -> dict:
+    # Merged busy (start, end) offsets per local date, splitting appointments that cross midnight
+    local_timezone = pytz.timezone(settings.TIME_ZONE)
+    intervals = defaultdict(list)
+    for appointment in appointments:
+        start = appointment.start.astimezone(local_timezone)
+        end = appointment.end.astimezone(local_timezone)
+        day = start.date()
+        while day <= end.date():
+            start_seconds = to_seconds(start.time()) if day == start.date() else 0
+            end_seconds = to_seconds(end.time()) if day == end.date() else SECONDS_PER_DAY
+            if start_seconds < end_seconds:
+                intervals[day].append((start_seconds, end_seconds))
+            day += dt.timedelta(days=1)
+    return {day: merge_intervals(day_intervals) for day, day_intervals in intervals.items()}
+
+
+def busy_intervals_by_professional(appointments) -> dict:
+    # {professional_id: {date: merged busy intervals}}
+    appointments_by_professional = defaultdict(list)
+    for appointment in appointments:
+        appointments_by_professional[appointment.professional_id].append(appointment)
+    return {
+        professional_id: busy_intervals_by_date(professional_appointments)
+        for professional_id, professional_appointments in appointments_by_professional.items()
+    }
+
+
+def assign_professionals(slots, professionals, busy: dict, date: dt.date, duration: int) -> list:
+    # Union of the professionals' free slots. Each slot goes to the least booked free
+    # professional of the day so that bookings spread evenly, ties broken by id.
+    def load(professional):
+        return sum(end - start for start, end in busy.get(professional.id, {}).get(date, [])), professional.id
+
+    assigned = {}
+    for professional in sorted(professionals, key=load):
+        for slot in free_slots(slots, busy.get(professional.id, {}).get(date, []), duration):
+            assigned.setdefault(slot, professional)
+    return sorted(assigned.items())
+
+
+def available_slots(professional, service, date: dt.date) -> array:
+    template = get_schedule_template(service.id)
+    window_start, window_end = local_window(date, date)
+    # Not professional.appointment_set, which sets the professional on every row and so reloads
+    # the deferred professional_id with one query per appointment
+    appointments = Appointment.objects.filter(
+        overlapping(window_start, window_end), professional_id=professional.pk
+    ).only('start', 'end')
+    busy = busy_intervals_by_date(appointments).get(date, [])
+    return array('I', free_slots(template.weekday_slots(date.weekday()), busy, duration_seconds(template)))
+
+
+def availability_cache_key(professional_id: int, service_id: int, date: dt.date) -> str:
+    # Timeframe and service changes bump the service version and appointment changes the
+    # professional version, instead of deleting every date and service
+    service_version = get_version(f'service:{service_id}')
+    professional_version = get_version(f'professional:{professional_id}')
+    return f'availability:{service_version}:{professional_version}:{professional_id}:{service_id}:{date.isoformat()}'
+
+
+def get_cached_available_times(professional, service, date: dt.date) -> list:
+    # The key is read before the appointments, so a miss racing a booking stores its
+    # slots under a version that the booking's commit has already left behind
+    key = availability_cache_key(professional.id, service.id, date)
+    slots = cache.get(key)
+    if slots is None:
+        availability_counter.miss()
+        slots = available_slots(professional, service, date)
+        cache.set(key, slots, timeout=AVAILABILITY_CACHE_TIMEOUT)
+    else:
+        availability_counter.hit()
+    return [from_seconds(slot) for slot in slots]
+
+
+def local_window(from_date: dt.date, to_date: dt.date) -> tuple:
+    # Aware [start of from_date, start of the day after to_date) in the local timezone, for
+    # start/end range filters that the (professional, start) index can serve
+    return (timezone.make_aware(dt.datetime.combine(from_date, dt.time.min)),
+            timezone.make_aware(dt.datetime.combine(to_date + dt.timedelta(days=1), dt.time.min)))
+
+
+def local_dates(start: dt.datetime, end: dt.datetime) -> set:
+    local_timezone = pytz.timezone(settings.TIME_ZONE)
+    day = start.astimezone(local_timezone).date()
+    last_day = end.astimezone(local_timezone).date()
+    dates = set()
+    while day <= last_day:
+        dates.add(day)
+        day += dt.timedelta(days=1)
+    return dates
+
+
+def rebuild_available_times(professional_id: int, dates):
+    # Called after commit. The bump drops every cached service of the professional, including the
+    # ones they no longer offer, then the linked services are written through on the given dates
+    # from one appointments query over their span, so a whole series costs the same as one booking.
+    bump_version(f'professional:{professional_id}')
+    dates = sorted(date for date in dates if date > timezone.now().date())
+    if not dates:
+        return
+    window_start, window_end = local_window(dates[0], dates[-1])
+    busy = busy_intervals_by_date(Appointment.objects.filter(
+        overlapping(window_start, window_end), professional_id=professional_id
+    ).only('start', 'end'))
+    entries = {}
+    for service_id in Service.objects.filter(professionals=professional_id).values_list('id', flat=True):
+        template = get_schedule_template(service_id)
+        duration = duration_seconds(template)
+        for date in dates:
+            slots = free_slots(template.weekday_slots(date.weekday()), busy.get(date, []), duration)
+            entries[availability_cache_key(professional_id, service_id, date)] = array('I', slots)
+    cache.set_many(entries, timeout=AVAILABILITY_CACHE_TIMEOUT)
+
+
+def get_available_times_range(professional, service, from_date: dt.date, to_date: dt.date) -> dict:
+    # Free slots for every date in [from_date, to_date] from one appointments query
+    template = get_schedule_template(service.id)
+    window_start, window_end = local_window(from_date, to_date)
+    # Filtered on professional_id for the same reason as in available_slots
+    appointments = Appointment.objects.filter(
+        overlapping(window_start, window_end), professional_id=professional.pk
+    ).only('start', 'end')
+    busy = busy_intervals_by_date(appointments)
+    duration = duration_seconds(template)
+
+    available_times = {}
+    date = from_date
+    while date <= to_date:
+        day_slots = template.weekday_slots(date.weekday())
+        available_times[date] = [from_seconds(slot) for slot in free_slots(day_slots, busy.get(date, []), duration)]
+        date += dt.timedelta(days=1)
+    return available_times
+
+
+def get_service_available_times(service, date: dt.date, location=None) -> list:
+    # (time, professional) pairs for every slot where some professional offering service is free
+    professionals = service.professionals.all()
+    if location is not None:
+        professionals = professionals.filter(location=location)
+    professionals = list(professionals)
+    template = get_schedule_template(service.id)
+    slots = template.weekday_slots(date.weekday())
+    if not professionals or not slots:
+        return []
+    window_start, window_end = local_window(date, date)
+    appointments = Appointment.objects.filter(
+        overlapping(window_start, window_end), professional__in=professionals
+    ).only('professional_id', 'start', 'end')
+    busy = busy_intervals_by_professional(appointments)
+    assigned = assign_professionals(slots, professionals, busy, date, duration_seconds(template))
+    return [(from_seconds(slot), professional) for slot, professional in assigned]
+
+
+def find_next_available(service, from_date: dt.date, horizon_days: int, professional=None, location=None):
+    # Earliest free (date, time, professional) within horizon_days of from_date, or None.
+    # Appointments are loaded in NEXT_AVAILABLE_CHUNK_DAYS chunks, so the number of
+    # queries is bounded by the horizon and the scan stops at the first chunk with a slot.
+    professionals = service.professionals.all()
+    if professional is not None:
+        professionals = professionals.filter(pk=professional)
+    if location is not None:
+        professionals = professionals.filter(location=location)
+    professionals = list(professionals)
+    template = get_schedule_template(service.id)
+    if not professionals or not any(template.slots):
+        return None
+
+    last_date = from_date + dt.timedelta(days=horizon_days - 1)
+    chunk_start = from_date
+    while chunk_start <= last_date:
+        chunk_end = min(chunk_start + dt.timedelta(days=NEXT_AVAILABLE_CHUNK_DAYS - 1), last_date)
+        window_start, window_end = local_window(chunk_start, chunk_end)
+        appointments = Appointment.objects.filter(
+            overlapping(window_start, window_end), professional__in=professionals
+        ).only('professional_id', 'start', 'end')
+        busy = busy_intervals_by_professional(appointments)
+
+        date = chunk_start
+        while date <= chunk_end:
+            slots = template.weekday_slots(date.weekday())
+            if slots:
+                assigned = assign_professionals(slots, professionals, busy, date, duration_seconds(template))
+                if assigned:
+                    slot, assigned_professional = assigned[0]
+                    return date, from_seconds(slot), assigned_professional
+            date += dt.timedelta(days=1)
+        chunk_start = chunk_end + dt.timedelta(days=1)
+    return None
@@ -0,0 +1,31 @@
+from django.db import IntegrityError, transaction
+
+from .models import Appointment, Professional, overlapping
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+def lock_professional(professional_id: int) -> Professional:
+    # Row lock held until the surrounding transaction ends, so bookings for the same
+    # professional are serialized while bookings for other professionals run in parallel.
+    return Professional.objects.select_for_update().get(pk=professional_id)
+
+
+def is_overlapping(professional_id: int, start, end) -> bool:
+    # Range query served by the (professional, start) unique index on active appointments
+    return Appointment.objects.filter(overlapping(start, end), professional_id=professional_id).exists()
+
+
+def create_appointment(appointment_serializer, **kwargs) -> Appointment:
+    # Must run inside transaction.atomic(); raises SlotUnavailable when the professional is taken
+    data = appointment_serializer.validated_data
+    lock_professional(data['professional'].pk)
+    if is_overlapping(data['professional'].pk, data['start'], data['end']):
+        raise SlotUnavailable
+    try:
+        with transaction.atomic():
+            return appointment_serializer.save(**kwargs)
+    except IntegrityError:
+        raise SlotUnavailable
@@ -0,0 +1,79 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from accounts.models import CompanyProfile
+from app.cache import HitCounter, bump_version, get_version
+from .models import Service
+
+catalog_counter = HitCounter('catalog')
+
+
+def catalog_version_name(company_id=None) -> str:
+    # Requests that are not scoped to a company are validated against the version of the whole catalog
+    return f'catalog:{company_id}' if company_id else 'catalog'
+
+
+def invalidate_catalog(company_id=None):
+    # After commit, so a request racing the transaction cannot tag old data with the new version
+    def bump():
+        if company_id:
+            bump_version(catalog_version_name(company_id))
+        bump_version(catalog_version_name())
+
+    transaction.on_commit(bump)
+
+
+def cached_company_id(key: str, queryset):
+    # Company of a service or slug, cached so that a 304 costs no query
+    company_id = cache.get(key)
+    if company_id is None:
+        company_id = queryset.values_list('company_id', flat=True).first()
+        if company_id is not None:
+            cache.set(key, company_id, timeout=None)
+    return company_id
+
+
+def service_company_id(service_id):
+    return cached_company_id(f'catalog:service:{service_id}', Service._base_manager.filter(pk=service_id))
+
+
+def slug_company_id(slug: str):
+    return cached_company_id(f'catalog:slug:{slug}', CompanyProfile.objects.filter(slug=slug))
+
+
+class CatalogConditionalGetMixin:
+    # ETag on list and retrieve from the catalog version of the requested company, checked against
+    # If-None-Match before the queryset or the serializer run
+    catalog_company_param = 'company'
+
+    def get_catalog_company_id(self):
+        value = self.request.query_params.get(self.catalog_company_param, '')
+        return int(value) if value.isdigit() else None
+
+    def get_catalog_etag(self) -> str:
+        version = get_version(catalog_version_name(self.get_catalog_company_id()))
+        key = f'{version}:{self.request.accepted_media_type}:{self.request.get_full_path()}'
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        # The version is read before the data, so a concurrent edit can only make the ETag too old
+        etag = self.get_catalog_etag()
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            catalog_counter.hit()
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        catalog_counter.miss()
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
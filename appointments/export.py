@@ -0,0 +1,66 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_COLUMNS = [
+    'id', 'start', 'end', 'service', 'price', 'professional', 'location', 'customer', 'customer_email',
+    'customer_phone', 'is_complete', 'observations', 'created_at',
+]
+
+
+def export_queryset(queryset):
+    # Only the columns of EXPORT_COLUMNS, joined in the same query
+    return queryset.select_related('service', 'professional', 'location', 'customer').only(
+        'id', 'start', 'end', 'is_complete', 'observations', 'created_at',
+        'service__name', 'service__price', 'professional__name', 'location__name',
+        'customer__first_name', 'customer__last_name', 'customer__email', 'customer__phone',
+    )
+
+
+def export_rows(queryset):
+    # Streams from the database cursor, so memory stays flat whatever the number of rows
+    for appointment in export_queryset(queryset).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield [
+            appointment.id,
+            timezone.localtime(appointment.start).isoformat(),
+            timezone.localtime(appointment.end).isoformat(),
+            appointment.service.name,
+            appointment.service.price,
+            appointment.professional.name,
+            appointment.location.name,
+            appointment.customer.full_name,
+            appointment.customer.email,
+            appointment.customer.phone,
+            appointment.is_complete,
+            appointment.observations,
+            timezone.localtime(appointment.created_at).isoformat(),
+        ]
+
+
+class Echo:
+    # File-like object whose write returns the line, for csv.writer in a generator
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+# export_format value: (line generator, content type, file extension)
+EXPORT_FORMATS = {
+    'csv': (csv_lines, 'text/csv', 'csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson', 'ndjson'),
+}
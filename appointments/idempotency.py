@@ -0,0 +1,66 @@
+import hashlib
+import json
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+class RequestKey(NamedTuple):
+    # Idempotency-Key of a request, scoped to its endpoint and user, and the hash of its body
+    scope: str
+    key: str
+    request_hash: str
+
+
+def request_hash(data) -> str:
+    if hasattr(data, 'lists'):
+        # Form bodies, with every value of repeated fields
+        data = dict(data.lists())
+    return hashlib.sha256(json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def get_idempotency_key(request, endpoint: str):
+    # RequestKey of the request, or None without the header
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return None
+    user = request.user.pk if request.user.is_authenticated else 'anonymous'
+    return RequestKey(f'{endpoint}:{user}', key, request_hash(request.data))
+
+
+def get_stored_response(request_key):
+    # Response stored for the key within the TTL, a 422 when the key came with another body, or None
+    if not request_key:
+        return None
+    cutoff = timezone.now() - settings.IDEMPOTENCY_KEY_TTL
+    stored = IdempotencyKey.objects.filter(scope=request_key.scope, key=request_key.key).first()
+    if stored is None:
+        return None
+    if stored.created_at < cutoff:
+        stored.delete()
+        return None
+    if stored.request_hash != request_key.request_hash:
+        return Response({'idempotency_key': ['La llave de idempotencia ya se usó con otra solicitud.']},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(stored.response, status=stored.status_code)
+
+
+def store_response(request_key, data, status_code):
+    # Call inside the transaction that performs the write, so the key and its effects
+    # commit together. A concurrent request with the same key fails with IntegrityError.
+    IdempotencyKey.objects.create(scope=request_key.scope, key=request_key.key,
+                                  request_hash=request_key.request_hash, status_code=status_code, response=data)
+
+
+def purge_expired_keys() -> int:
+    cutoff = timezone.now() - settings.IDEMPOTENCY_KEY_TTL
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
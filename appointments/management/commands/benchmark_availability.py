@@ -0,0 +1,65 @@
+import datetime as dt
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from appointments.availability import free_slots, from_seconds, merge_intervals
+from appointments.schedule import slot_grid, to_seconds
+
+
+def legacy_available_times(windows, busy_times, duration, gap):
+    # Per-slot loop that AvailableTimesView used before the availability engine
+    available_times = []
+    for start_time, end_time in windows:
+        current_time = start_time
+        while current_time < end_time:
+            valid_time = True
+            for busy_time_start, busy_time_end in busy_times:
+                if busy_time_start <= current_time < busy_time_end:
+                    valid_time = False
+                    current_time = (dt.datetime.combine(dt.date(1, 1, 1), current_time) + duration + gap).time()
+                    break
+            if valid_time:
+                available_times.append(current_time)
+                current_time = (dt.datetime.combine(dt.date(1, 1, 1), current_time) + duration + gap).time()
+    return available_times
+
+
+def engine_available_times(windows, busy_times, duration, gap):
+    step = int((duration + gap).total_seconds())
+    slots = slot_grid([(to_seconds(start), to_seconds(end)) for start, end in windows], step)
+    busy = merge_intervals((to_seconds(start), to_seconds(end)) for start, end in busy_times)
+    return [from_seconds(slot) for slot in free_slots(slots, busy, int(duration.total_seconds()))]
+
+
+class Command(BaseCommand):
+    help = "Compare the legacy per-slot availability loop against the availability engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        duration = dt.timedelta(minutes=1)
+        gap = dt.timedelta(minutes=0)
+        windows = [(dt.time(0, 0), dt.time(23, 59))]
+        for size in options['sizes']:
+            minutes = random.sample(range(23 * 60 + 59), min(size, 23 * 60 + 59))
+            busy_times = [(from_seconds(minute * 60), from_seconds(minute * 60 + 60)) for minute in minutes]
+
+            results = {}
+            timings = {}
+            for name, function in [('legacy', legacy_available_times), ('engine', engine_available_times)]:
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    results[name] = function(windows, busy_times, duration, gap)
+                timings[name] = (time.perf_counter() - start) / options['repeat'] * 1000
+
+            if results['legacy'] != results['engine']:
+                self.stderr.write(f"{size} appointments: results differ")
+            self.stdout.write(
+                f"{size:>5} appointments/day: legacy {timings['legacy']:.2f} ms, "
+                f"engine {timings['engine']:.2f} ms ({timings['legacy'] / timings['engine']:.1f}x)"
+            )
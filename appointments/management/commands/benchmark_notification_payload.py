@@ -0,0 +1,69 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from appointments.models import Appointment
+from appointments.notifications import PAYLOAD_VERSION, build_appointment_payload
+from appointments.templatetags.custom_tags import duration
+
+
+def legacy_appointment_payload(appointment):
+    # Payload NewAppointmentView built by walking the relations lazily before the payload builder
+    return {
+        'customer_email': appointment.customer.email,
+        "customer_full_name": appointment.customer.full_name,
+        "start": appointment.start.isoformat(),
+        "end": appointment.end.isoformat(),
+        "company_email": appointment.service.company.email,
+        "company_phone": appointment.service.company.phone,
+        "company_address": appointment.service.company.companyprofile.address,
+        "company_name": appointment.service.company.companyprofile.name,
+        "customer_phone": appointment.customer.phone,
+        "service_duration": duration(appointment.service.duration),
+        "service_description": appointment.service.description,
+        "service_name": appointment.service.name,
+        "date": appointment.start.date().isoformat(),
+        "time": appointment.start.time().isoformat(),
+        "professional_name": appointment.professional.name,
+        "calendar_id": appointment.service.company.companyprofile.calendar_id,
+        "start_isoformat": appointment.start.isoformat(),
+        "end_isoformat": appointment.end.isoformat(),
+        "google_credentials": appointment.service.company.companyprofile.google_credentials,
+        "location_is_virtual": appointment.location.is_virtual,
+        "reviews_link": appointment.service.company.companyprofile.reviews_link
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare query count and broker message size of the legacy and current booking notifications."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--appointment', type=int, help="Appointment id, defaults to the latest one")
+
+    def handle(self, *args, **options):
+        appointments = Appointment.objects.order_by('-id')
+        if options['appointment']:
+            appointments = appointments.filter(pk=options['appointment'])
+        appointment = appointments.first()
+        if appointment is None:
+            raise CommandError("No appointment to benchmark")
+        tasks = 5
+
+        with CaptureQueriesContext(connection) as legacy_queries:
+            legacy_payload = legacy_appointment_payload(Appointment.objects.get(pk=appointment.pk))
+        legacy_size = len(json.dumps([legacy_payload]))
+
+        with CaptureQueriesContext(connection) as worker_queries:
+            build_appointment_payload(appointment.pk)
+        message_size = len(json.dumps([appointment.pk, PAYLOAD_VERSION]))
+
+        self.stdout.write(
+            f"legacy: {len(legacy_queries) - 1} queries in the request, "
+            f"{legacy_size} bytes x {tasks} messages"
+        )
+        self.stdout.write(
+            f"current: 0 queries in the request, {len(worker_queries)} query per task in the worker, "
+            f"{message_size} bytes x {tasks} messages"
+        )
@@ -0,0 +1,79 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from app.parsers import ORJSONParser
+from app.renderers import ORJSONRenderer
+from appointments.management.commands import benchmark_stats
+from appointments.stats import compute_company_stats, rebuild_company_stats
+from appointments.views import AppointmentViewSet
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Seed a company in a rolled back transaction and compare DRF's JSON renderer and parser "
+            "with the orjson ones on the stats and appointment list payloads.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--appointments', type=int, default=20_000)
+        parser.add_argument('--services', type=int, default=8)
+        parser.add_argument('--professionals', type=int, default=10)
+        parser.add_argument('--customers', type=int, default=2_000)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--rows', type=int, default=1_000, help="Appointments in the list payload")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def list_payload(self, company, rows: int):
+        # What AppointmentViewSet serializes for ?get_all=true
+        view = AppointmentViewSet(action='list', request=Request(APIRequestFactory().get('/')), format_kwarg=None)
+        queryset = view.get_queryset().filter(service__company=company)[:rows]
+        return view.get_serializer(queryset, many=True).data
+
+    def measure(self, function, repeat: int):
+        # Best of repeat, which leaves out collections and other noise
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - started)
+        return result, min(timings)
+
+    def compare(self, name: str, payload, repeat: int):
+        legacy, legacy_elapsed = self.measure(lambda: JSONRenderer().render(payload), repeat)
+        rendered, elapsed = self.measure(lambda: ORJSONRenderer().render(payload), repeat)
+        self.stdout.write(
+            f"render {name:6} {len(rendered):9} bytes  json {legacy_elapsed * 1000:8.2f} ms  "
+            f"orjson {elapsed * 1000:8.2f} ms  ({legacy_elapsed / elapsed:.1f}x)  same output: {rendered == legacy}"
+        )
+        legacy_data, legacy_elapsed = self.measure(lambda: JSONParser().parse(io.BytesIO(rendered)), repeat)
+        data, elapsed = self.measure(lambda: ORJSONParser().parse(io.BytesIO(rendered)), repeat)
+        self.stdout.write(
+            f"parse  {name:6} {len(rendered):9} bytes  json {legacy_elapsed * 1000:8.2f} ms  "
+            f"orjson {elapsed * 1000:8.2f} ms  ({legacy_elapsed / elapsed:.1f}x)  same data: {data == legacy_data}"
+        )
+
+    def run(self, options):
+        started = time.perf_counter()
+        company = benchmark_stats.Command().seed(options)
+        rebuild_company_stats(company.id)
+        self.stdout.write(f"seeded {options['appointments']} appointments in {time.perf_counter() - started:.1f} s")
+
+        self.compare('stats', compute_company_stats(company), options['repeat'])
+        self.compare('list', self.list_payload(company, options['rows']), options['repeat'])
@@ -0,0 +1,99 @@
+import datetime as dt
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import filters
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from accounts.models import Company, Customer
+from appointments.models import Appointment, Location, Professional, Service
+from appointments.search import AppointmentSearchFilter
+
+FIRST_NAMES = ['Ana', 'Camila', 'Daniela', 'Juan', 'Santiago', 'Valentina', 'Mateo', 'Sofía', 'Andrés', 'Lucía']
+SERVICES = ['Limpieza dental', 'Ortodoncia', 'Blanqueamiento', 'Endodoncia', 'Valoración']
+LOCATIONS = ['Chapinero', 'Usaquén', 'Suba', 'Centro']
+
+
+class Rollback(Exception):
+    pass
+
+
+class SearchView:
+    # Stand-in for AppointmentViewSet with the search_fields the legacy SearchFilter used
+    search_fields = ['customer__first_name', 'location__name', 'service__name', 'professional__name']
+
+
+class Command(BaseCommand):
+    help = "Seed appointments in a rolled back transaction and compare SearchFilter with the indexed search."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--appointments', type=int, default=100_000)
+        parser.add_argument('--customers', type=int, default=5_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--terms', nargs='+', default=['camila', 'orto', 'ana suba', 'dr 7', 'zzz'])
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, options) -> Company:
+        suffix = uuid.uuid4().hex[:8]
+        company = Company.objects.create_user(email=f'search-{suffix}@example.com', first_name='Search',
+                                              last_name='Benchmark')
+        locations = [Location.objects.create(name=name, address=name, phone='0', company=company)
+                     for name in LOCATIONS]
+        services = [Service.objects.create(name=name, price=50_000, duration=dt.timedelta(minutes=30),
+                                           time_between_appointments=dt.timedelta(0), company=company)
+                    for name in SERVICES]
+        professionals = [Professional.objects.create(name=f'Dr {index}', company=company, location=locations[0])
+                         for index in range(20)]
+        random.seed(0)
+        Customer.objects.bulk_create(
+            Customer(email=f'search-{suffix}-{index}@example.com', first_name=random.choice(FIRST_NAMES),
+                     last_name=str(index), role=Customer.BASE_ROLE)
+            for index in range(options['customers'])
+        )
+        customers = list(Customer.objects.filter(email__startswith=f'search-{suffix}-'))
+
+        first_start = timezone.now() - dt.timedelta(days=365)
+        appointments = []
+        for index in range(options['appointments']):
+            start = first_start + dt.timedelta(minutes=30 * (index // len(professionals)))
+            appointment = Appointment(
+                service=random.choice(services), location=random.choice(locations),
+                professional=professionals[index % len(professionals)], customer=random.choice(customers),
+                start=start, end=start + dt.timedelta(minutes=30),
+            )
+            appointment.search_document = appointment.get_search_document()
+            appointments.append(appointment)
+        Appointment.objects.bulk_create(appointments, batch_size=2_000)
+        return company
+
+    def measure(self, search_filter, term, company, repeat):
+        request = Request(APIRequestFactory().get('/', {'search': term}))
+        queryset = Appointment.objects.filter(service__company=company)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            ids = set(search_filter.filter_queryset(request, queryset, SearchView()).values_list('id', flat=True))
+        return ids, (time.perf_counter() - started) / repeat
+
+    def run(self, options):
+        started = time.perf_counter()
+        company = self.seed(options)
+        self.stdout.write(f"seeded {options['appointments']} appointments in {time.perf_counter() - started:.1f} s")
+        for term in options['terms']:
+            legacy_ids, legacy_elapsed = self.measure(filters.SearchFilter(), term, company, options['repeat'])
+            ids, elapsed = self.measure(AppointmentSearchFilter(), term, company, options['repeat'])
+            self.stdout.write(
+                f"{term!r:22} {len(ids):6} rows  legacy {legacy_elapsed * 1000:8.1f} ms  "
+                f"indexed {elapsed * 1000:8.1f} ms  ({legacy_elapsed / elapsed:.1f}x)  same rows: {ids == legacy_ids}"
+            )
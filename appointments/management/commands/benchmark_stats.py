@@ -0,0 +1,185 @@
+import datetime as dt
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from accounts.models import Company, Customer
+from appointments.models import Appointment, Location, Professional, Service
+from appointments.stats import compute_company_stats, rebuild_company_stats
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_company_stats(company) -> dict:
+    # StatsView before compute_company_stats, without the timing print
+    stats = {}
+
+    appointments = Appointment.objects.filter(service__company=company)
+    services = Service.objects.filter(company=company).values_list('name', flat=True)
+    professionals = Professional.objects.filter(company=company).values_list('name', flat=True)
+    dates = appointments.values_list('start__date', flat=True).distinct().order_by('start__date')
+
+    appointments_per_service_per_date = appointments.values('start__date', 'service__name').annotate(
+        count=Count('id'))
+    revenue_per_service_per_date = appointments.values('start__date', 'service__name').annotate(
+        revenue=Sum('service__price'))
+    appointments_per_professional_per_date = appointments.values('start__date', 'professional__name').annotate(
+        count=Count('id'))
+
+    stats['appointments_per_service_per_date'] = [["Date"] + list(services)]
+    for date in dates:
+        row = [date]
+        for service in services:
+            count = next((item['count'] for item in appointments_per_service_per_date if
+                          item['start__date'] == date and item['service__name'] == service), 0)
+            row.append(count)
+        stats['appointments_per_service_per_date'].append(row)
+
+    stats['appointments_per_service'] = [["Service", "Count"]]
+    for service in services:
+        count = appointments.filter(service__name=service).count()
+        stats['appointments_per_service'].append([service, count])
+
+    stats['revenue_per_service_per_date'] = [["Date"] + list(services)]
+    for date in dates:
+        row = [date]
+        for service in services:
+            revenue = next((item['revenue'] for item in revenue_per_service_per_date if
+                            item['start__date'] == date and item['service__name'] == service), 1_000_000)
+            row.append(revenue)
+        stats['revenue_per_service_per_date'].append(row)
+
+    stats['appointments_per_professional_per_date'] = [["Date"] + list(professionals)]
+    for date in dates:
+        row = [date]
+        for professional in professionals:
+            count = next((item['count'] for item in appointments_per_professional_per_date if
+                          item['start__date'] == date and item['professional__name'] == professional), 0)
+            row.append(count)
+        stats['appointments_per_professional_per_date'].append(row)
+
+    stats['revenue_this_month'] = (
+            appointments.filter(start__month=timezone.now().month)
+            .aggregate(Sum('service__price'))['service__price__sum'] or 1_000_000
+    )
+
+    appointments_this_month = appointments.filter(start__month=timezone.now().month)
+    stats['appointments_this_month'] = appointments_this_month.count()
+
+    appointments_before_this_month = appointments.filter(start__lt=timezone.now().replace(day=1))
+    old_customers = []
+    for appointment in appointments_before_this_month:
+        if appointment.customer not in old_customers:
+            old_customers.append(appointment.customer)
+    new_customers = []
+    for appointment in appointments_this_month:
+        if appointment.customer not in old_customers and appointment.customer not in new_customers:
+            new_customers.append(appointment.customer)
+
+    stats['new_customers_this_month'] = len(new_customers)
+    customers = old_customers + new_customers
+    stats['total_revenue'] = appointments.aggregate(Sum('service__price'))['service__price__sum'] or 0
+    stats['total_appointments'] = appointments.count()
+    stats['total_customers'] = len(customers)
+    return stats
+
+
+class Command(BaseCommand):
+    help = "Seed a company with many appointments in a rolled back transaction and time the stats computation."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--appointments', type=int, default=100_000)
+        parser.add_argument('--services', type=int, default=8)
+        parser.add_argument('--professionals', type=int, default=10)
+        parser.add_argument('--customers', type=int, default=2_000)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--skip-legacy', action='store_true',
+                            help="Only time the current implementation; the legacy one takes minutes at 100k")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, options) -> Company:
+        suffix = uuid.uuid4().hex[:8]
+        company = Company.objects.create_user(email=f'stats-{suffix}@example.com', first_name='Stats',
+                                              last_name='Benchmark')
+        location = Location.objects.create(name='Stats', address='Stats', phone='0', company=company)
+        services = [
+            Service.objects.create(name=f'Service {index}', price=10_000 * (index + 1),
+                                   duration=dt.timedelta(minutes=30), time_between_appointments=dt.timedelta(0),
+                                   company=company)
+            for index in range(options['services'])
+        ]
+        professionals = [
+            Professional.objects.create(name=f'Professional {index}', company=company, location=location)
+            for index in range(options['professionals'])
+        ]
+        customers = Customer.objects.bulk_create(
+            Customer(email=f'stats-{suffix}-{index}@example.com', first_name='Stats', last_name=str(index),
+                     role=Customer.BASE_ROLE)
+            for index in range(options['customers'])
+        )
+        if not customers[0].pk:
+            customers = list(Customer.objects.filter(email__startswith=f'stats-{suffix}-'))
+
+        # Appointments end around now so the month and new customer figures are exercised,
+        # spread evenly over the professionals so (professional, start) stays unique
+        slots_per_day = max(1, -(-options['appointments'] // (options['days'] * len(professionals))))
+        step = dt.timedelta(days=1) / slots_per_day
+        first_day = timezone.localdate() - dt.timedelta(days=options['days'] - 1)
+        first_start = timezone.make_aware(dt.datetime.combine(first_day, dt.time(0)))
+        appointments = []
+        for index in range(options['appointments']):
+            start = first_start + step * (index // len(professionals))
+            appointments.append(Appointment(
+                service=services[index % len(services)], location=location,
+                professional=professionals[index % len(professionals)],
+                customer=customers[(index * 7919) % len(customers)],
+                start=start, end=start + dt.timedelta(minutes=30),
+            ))
+        Appointment.objects.bulk_create(appointments, batch_size=2_000)
+        return company
+
+    def measure(self, function, company):
+        # Counted with a wrapper because query logging stops at 9000 queries
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            started = time.perf_counter()
+            stats = function(company)
+            elapsed = time.perf_counter() - started
+        return stats, elapsed, len(queries)
+
+    def run(self, options):
+        started = time.perf_counter()
+        company = self.seed(options)
+        self.stdout.write(f"seeded {options['appointments']} appointments in {time.perf_counter() - started:.1f} s")
+        # bulk_create skips the signals that keep the rollup current
+        started = time.perf_counter()
+        buckets = rebuild_company_stats(company.id)
+        self.stdout.write(f"rebuilt {buckets} daily buckets in {time.perf_counter() - started:.1f} s")
+
+        stats, elapsed, queries = self.measure(compute_company_stats, company)
+        self.stdout.write(f"current: {elapsed * 1000:.0f} ms, {queries} queries")
+        if options['skip_legacy']:
+            return
+
+        legacy_stats, legacy_elapsed, legacy_queries = self.measure(legacy_company_stats, company)
+        self.stdout.write(f"legacy: {legacy_elapsed * 1000:.0f} ms, {legacy_queries} queries")
+        differences = [key for key in legacy_stats if stats[key] != legacy_stats[key]]
+        self.stdout.write(f"speed-up: {legacy_elapsed / elapsed:.1f}x, differences: {', '.join(differences) or 'none'}")
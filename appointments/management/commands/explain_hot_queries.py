@@ -0,0 +1,121 @@
+import datetime as dt
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+from appointments.availability import local_window
+from appointments.models import Appointment, CompanyCustomer, DailyCompanyStats, Service, overlapping
+from appointments.stats import month_bounds
+
+
+def table_indexes(model) -> dict:
+    # {index name: indexed columns}, including indexes the backend named itself (sqlite_autoindex_*)
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = {
+            name: tuple(constraint['columns'])
+            for name, constraint in constraints.items()
+            if constraint['index'] or constraint['unique']
+        }
+        if connection.vendor == 'sqlite':
+            # Table-level UNIQUE constraints are backed by autoindexes that introspection reports by constraint name
+            cursor.execute(f'PRAGMA index_list({connection.ops.quote_name(table)})')
+            for name in [row[1] for row in cursor.fetchall() if row[1].startswith('sqlite_autoindex')]:
+                cursor.execute(f'PRAGMA index_info({connection.ops.quote_name(name)})')
+                indexes[name] = tuple(row[2] for row in sorted(cursor.fetchall()))
+    return indexes
+
+
+def index_conditions(plan: str) -> str:
+    # What the index is searched on: SQLite prints it after "USING INDEX name", PostgreSQL as "Index Cond"
+    conditions = re.findall(r'USING (?:COVERING )?INDEX \S+ \((.*)\)', plan)
+    conditions += re.findall(r'Index Cond: (.*)', plan)
+    return '\n'.join(conditions)
+
+
+def is_bounded(conditions: str, column: str) -> bool:
+    # A range with only one side reads the index from there to the end of the professional's history
+    return set(re.findall(rf'\b{column}"?\s*([<>])', conditions)) == {'<', '>'}
+
+
+class Command(BaseCommand):
+    help = ("Print the plans of the availability, booking, listing and stats queries and the indexes they use. "
+            "Run it against a production-sized copy: planners scan small tables whatever the indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Fail when a query uses none of its indexes or seeks its range from one side only")
+        parser.add_argument('--verbose-plans', action='store_true', help="Print the full plans")
+
+    def hot_queries(self):
+        # (name, queryset, column lists of the indexes expected to serve it, column the index must seek as a
+        # range bounded on both sides or None); ids come from existing rows if any
+        appointment = Appointment.objects.order_by('-id').first()
+        service = Service.objects.order_by('-id').first()
+        professional_id = appointment.professional_id if appointment else 1
+        service_id = service.id if service else 1
+        company_id = service.company_id if service else 1
+        customer_id = appointment.customer_id if appointment else 1
+        today = timezone.localdate()
+        window_start, window_end = local_window(today, today)
+        first_day, next_first_day = month_bounds(today)
+        month_start, month_end = local_window(first_day, next_first_day - dt.timedelta(days=1))
+
+        return [
+            ('availability: busy times of a professional on a day',
+             Appointment.objects.filter(overlapping(window_start, window_end), professional_id=professional_id)
+             .only('start', 'end'),
+             [('professional_id', 'start')], 'start'),
+            ('booking: overlap check',
+             Appointment.objects.filter(overlapping(window_start, window_end), professional_id=professional_id)
+             .values('id')[:1],
+             [('professional_id', 'start')], 'start'),
+            ('listing: keyset page of a company',
+             Appointment.objects.filter(service__company_id=company_id, start__gt=window_start)
+             .order_by('start', 'id')[:10],
+             [('start', 'id'), ('service_id', 'start')], None),
+            ('stats: recount of a daily bucket',
+             Appointment.objects.filter(service_id=service_id, professional_id=professional_id,
+                                        start__gte=window_start, start__lt=window_end),
+             [('professional_id', 'start'), ('service_id', 'start')], 'start'),
+            ('stats: first appointment of a customer',
+             Appointment.objects.filter(service__company_id=company_id, customer_id=customer_id)
+             .values('customer_id').annotate(first=Min('start')),
+             [('customer_id', 'start')], None),
+            ('stats: rollup rows of a month',
+             DailyCompanyStats.objects.filter(company_id=company_id, date__gte=first_day, date__lt=next_first_day),
+             [('company_id', 'date', 'service_id', 'professional_id')], 'date'),
+            ('stats: customers of a month',
+             CompanyCustomer.objects.filter(company_id=company_id, first_appointment__gte=month_start,
+                                            first_appointment__lt=month_end),
+             [('company_id', 'first_appointment')], 'first_appointment'),
+        ]
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset, expected, range_column in self.hot_queries():
+            plan = queryset.explain()
+            indexes = table_indexes(queryset.model)
+            used = sorted(index for index in indexes if index in plan)
+            status = 'OK'
+            if not any(indexes[index] in expected for index in used):
+                status = 'NOT USED'
+            elif range_column:
+                conditions = index_conditions(plan)
+                # Backends that print no index condition cannot be checked
+                if conditions and not is_bounded(conditions, range_column):
+                    status = 'ONE-SIDED'
+            if status != 'OK':
+                failed.append(name)
+            expected_columns = ' or '.join('(' + ', '.join(columns) + ')' for columns in expected)
+            self.stdout.write(f"{status:9} {name}: uses {', '.join(used) or 'no index'}; "
+                              f"expected one on {expected_columns}"
+                              + (f", seeking a {range_column} range" if range_column else ''))
+            if options['verbose_plans'] or status != 'OK':
+                self.stdout.write(f'    {plan}'.replace('\n', '\n    '))
+        if failed and options['check']:
+            raise CommandError(f"{len(failed)} hot queries do not use their indexes or seek them from one side only")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from appointments.models import Appointment
+from appointments.search import install_search_index, refresh_search_documents
+
+
+class Command(BaseCommand):
+    help = "Create the appointment search index if it is missing and backfill stale search documents."
+
+    def handle(self, *args, **options):
+        install_search_index(DEFAULT_DB_ALIAS)
+        changed = refresh_search_documents(Appointment._base_manager.all())
+        self.stdout.write(f'{changed} search documents updated')
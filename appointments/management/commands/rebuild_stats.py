@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import Company
+from appointments.stats import rebuild_company_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily stats rollup and first appointment table from the appointments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', help="Company id, all companies if omitted")
+
+    def handle(self, *args, **options):
+        companies = Company.objects.order_by('id')
+        if options['company']:
+            companies = companies.filter(pk__in=options['company'])
+        for company_id in companies.values_list('id', flat=True):
+            buckets = rebuild_company_stats(company_id)
+            self.stdout.write(f'company {company_id}: {buckets} daily buckets')
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from appointments.outbox import relay_outbox
+
+
+class Command(BaseCommand):
+    help = "Publish pending outbox messages to Celery, once or in a loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Keep relaying until interrupted")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to sleep when the outbox is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            relayed = relay_outbox()
+            if relayed:
+                self.stdout.write(f'relayed {relayed} messages')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,89 @@
+import datetime as dt
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.models import Company, Customer
+from appointments.booking import SlotUnavailable, create_appointment
+from appointments.models import Appointment, Location, Professional, Service, TimeFrame, WeekDay
+from appointments.serializers import BookingAppointmentSerializer
+
+
+class Command(BaseCommand):
+    help = "Book the same professional from many threads and check that no slot is double booked."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--slots', type=int, default=8)
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        company = Company.objects.create_user(email=f'stress-{suffix}@example.com', first_name='Stress', last_name='Test')
+        customer = Customer.objects.create_user(email=f'stress-customer-{suffix}@example.com', first_name='Stress',
+                                                last_name='Customer')
+        location = Location.objects.create(name='Stress', address='Stress', phone='0', company=company)
+        service = Service.objects.create(name='Stress', price=0, duration=dt.timedelta(minutes=30),
+                                         time_between_appointments=dt.timedelta(0), company=company)
+        for weekday in WeekDay.objects.all():
+            TimeFrame.objects.create(service=service, weekday=weekday, start_time=dt.time(0), end_time=dt.time(23))
+        professional = Professional.objects.create(name='Stress', company=company, location=location)
+        professional.services.add(service)
+
+        # Starts every 15 minutes while appointments last 30, so neighbouring requests overlap
+        day = timezone.localdate() + dt.timedelta(days=7)
+        first_start = timezone.make_aware(dt.datetime.combine(day, dt.time(8)))
+        starts = [first_start + dt.timedelta(minutes=15 * index) for index in range(options['slots'])]
+
+        counts = {'created': 0, 'conflict': 0, 'error': 0}
+        lock = threading.Lock()
+        pending = iter(range(options['requests']))
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(pending, None)
+                if index is None:
+                    break
+                start = starts[index % len(starts)]
+                serializer = BookingAppointmentSerializer(data={
+                    'service': service.id, 'location': location.id, 'professional': professional.id,
+                    'start': start, 'end': start + service.duration,
+                })
+                try:
+                    serializer.is_valid(raise_exception=True)
+                    with transaction.atomic():
+                        create_appointment(serializer, customer=customer)
+                    result = 'created'
+                except SlotUnavailable:
+                    result = 'conflict'
+                except Exception as e:
+                    self.stderr.write(f'{type(e).__name__}: {e}')
+                    result = 'error'
+                with lock:
+                    counts[result] += 1
+            connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        booked = list(Appointment.objects.filter(professional=professional).order_by('start'))
+        double_bookings = sum(1 for previous, current in zip(booked, booked[1:]) if current.start < previous.end)
+
+        self.stdout.write(
+            f"{options['requests']} bookings on {options['threads']} threads in {elapsed:.2f} s "
+            f"({options['requests'] / elapsed:.0f} req/s): {counts['created']} created, "
+            f"{counts['conflict']} conflicts, {counts['error']} errors, {double_bookings} double bookings"
+        )
+
+        Company.objects.filter(pk=company.pk).delete()
+        Customer.objects.filter(pk=customer.pk).delete()
@@ -2,11 +2,22 @@ import datetime as dt
 
 import pytz
 from django.conf import settings
-from django.core.validators import MinValueValidator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from accounts.models import Company, Customer
 
 
+# Longest an appointment may last. An appointment overlapping a window starts less than this
+# before the window, which gives overlap filters a lower bound on the (professional, start) index.
+MAX_APPOINTMENT_DURATION = dt.timedelta(hours=24)
+
+
+def overlapping(start: dt.datetime, end: dt.datetime) -> models.Q:
+    # Appointments overlapping [start, end), as a start range the index can seek on both sides
+    return models.Q(start__gt=start - MAX_APPOINTMENT_DURATION, start__lt=end, end__gt=start)
+
+
 class NonDeletableManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().filter(active=True)
@@ -29,6 +40,13 @@ class NonDeletableModel(models.Model):
             self.active = True
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Keep the stored values so signal handlers can tell what an edit moved away from
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
 
 class WeekDay(models.Model):
     name = models.CharField(max_length=10)
@@ -40,7 +58,8 @@ class WeekDay(models.Model):
 class Service(NonDeletableModel):
     name = models.CharField(max_length=100)
     price = models.IntegerField()
-    duration = models.DurationField(validators=[MinValueValidator(dt.timedelta(minutes=15))])
+    duration = models.DurationField(validators=[MinValueValidator(dt.timedelta(minutes=15)),
+                                           MaxValueValidator(MAX_APPOINTMENT_DURATION)])
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     time_between_appointments = models.DurationField()
     description = models.TextField(blank=True)
@@ -51,11 +70,8 @@ class Service(NonDeletableModel):
 
     def get_timeframes(self) -> dict:
         timeframes = {}
-        weekdays = WeekDay.objects.order_by('index')
-        for weekday in weekdays:
-            specific_timeframes = self.timeframe_set.filter(weekday=weekday, is_enabled=True)
-            if len(specific_timeframes) > 0:
-                timeframes[weekday.name] = specific_timeframes
+        for timeframe in self.timeframe_set.select_related('weekday').order_by('weekday_id', 'start_time'):
+            timeframes.setdefault(timeframe.weekday.name, []).append(timeframe)
 
         return timeframes
 
@@ -63,6 +79,10 @@ class Service(NonDeletableModel):
         return self.appointment_set.filter(start__date=date)
 
 
+# Related fields copied into Appointment.search_document, the former search_fields of AppointmentViewSet
+SEARCH_DOCUMENT_FIELDS = ['customer__first_name', 'location__name', 'service__name', 'professional__name']
+
+
 class Appointment(NonDeletableModel):
     location = models.ForeignKey('Location', on_delete=models.RESTRICT)
     service = models.ForeignKey(Service, on_delete=models.CASCADE)
@@ -75,13 +95,57 @@ class Appointment(NonDeletableModel):
     reminder_sent = models.BooleanField(default=False)
     review_email_sent = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    series = models.ForeignKey('AppointmentSeries', on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='appointments')
+    # Denormalized copy of the searched related names, indexed by appointments.search
+    search_document = models.TextField(blank=True, default='', editable=False)
 
     class Meta:
-        unique_together = ('service', 'start')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['professional', 'start'],
+                condition=models.Q(active=True),
+                name='unique_active_professional_start',
+            ),
+        ]
+        # Partial on active=True like the default manager; backends without partial indexes skip them
+        indexes = [
+            models.Index(fields=['service', 'start'], condition=models.Q(active=True),
+                         name='appt_active_service_start_idx'),
+            models.Index(fields=['start', 'id'], condition=models.Q(active=True),
+                         name='appt_active_start_id_idx'),
+            models.Index(fields=['customer', 'start'], condition=models.Q(active=True),
+                         name='appt_active_customer_start_idx'),
+        ]
 
     def __str__(self) -> str:
         return f'{self.customer}: {self.service} From {self.start} to {self.end}'
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'search_document' in update_fields:
+            self.search_document = self.get_search_document()
+        super().save(*args, **kwargs)
+
+    def get_search_document(self) -> str:
+        # Lowercased values of SEARCH_DOCUMENT_FIELDS, one per line so that no term matches across two
+        values = []
+        for path in SEARCH_DOCUMENT_FIELDS:
+            value = self
+            for attribute in path.split('__'):
+                value = getattr(value, attribute)
+            values.append(str(value or ''))
+        return '\n'.join(values).lower()
+
+
+class AppointmentSeries(models.Model):
+    rule = models.CharField(max_length=255)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f'{self.customer}: {self.rule}'
+
 
 """
 def schedule_reminder_email(instance: Appointment):
@@ -124,14 +188,12 @@ class TimeFrame(models.Model):
     def get_times(self) -> list:
         times: list = []
 
-        current_time = self.start_time
-        while current_time < self.end_time:
-            times.append(current_time)
-            duration = self.service.duration
-            gap_time = self.service.time_between_appointments
-            # Add duration to current time
-            current_time = dt.datetime.combine(dt.date(1, 1, 1), current_time) + duration + gap_time
-            current_time = current_time.time()
+        step = self.service.duration + self.service.time_between_appointments
+        current_time = dt.datetime.combine(dt.date.min, self.start_time)
+        end_time = dt.datetime.combine(dt.date.min, self.end_time)
+        while current_time < end_time:
+            times.append(current_time.time())
+            current_time += step
         return times
 
 
@@ -160,8 +222,6 @@ class Professional(NonDeletableModel):
 
     def get_busy_times(self, date: dt.date) -> list:
         appointments = self.appointment_set.filter(start__date=date)
-        print(date)
-        print(appointments)
         #Get times in current timezone
         timezone = pytz.timezone(settings.TIME_ZONE)
         busy_times = [
@@ -200,3 +260,78 @@ class AdditionalQuestionResponse(models.Model):
 
     def __str__(self) -> str:
         return self.response
+
+
+class IdempotencyKey(models.Model):
+    # Keys are unique per endpoint and user, and remember the hash of the body they came with
+    scope = models.CharField(max_length=100, default='')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64, default='')
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_scope_key'),
+        ]
+
+    def __str__(self) -> str:
+        return self.key
+
+
+class OutboxMessage(models.Model):
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    eta = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(sent_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.task}{tuple(self.args)}'
+
+
+class DailyCompanyStats(models.Model):
+    # Rollup of the active appointments of a service and professional on a local date
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    date = models.DateField()
+    service = models.ForeignKey(Service, on_delete=models.CASCADE)
+    professional = models.ForeignKey(Professional, on_delete=models.CASCADE)
+    appointments = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+    customers = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['company', 'date', 'service', 'professional'],
+                name='unique_daily_company_stats',
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.date}: {self.service_id}/{self.professional_id} {self.appointments}'
+
+
+class CompanyCustomer(models.Model):
+    # First active appointment of a customer with a company, for new and total customer counts
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='+')
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='+')
+    first_appointment = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'customer'], name='unique_company_customer'),
+        ]
+        indexes = [
+            models.Index(fields=['company', 'first_appointment'], name='company_first_appointment_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.company_id}: {self.customer_id}'
@@ -0,0 +1,54 @@
+from django.utils import timezone
+
+from .models import Appointment
+from .templatetags.custom_tags import duration
+
+# Version of the message format sent to the notification tasks. Version 1 carries
+# only the appointment id; earlier messages carried the whole payload dict.
+PAYLOAD_VERSION = 1
+
+
+def build_appointment_payload(appointment_id: int):
+    # Context of the notification tasks for an active appointment, from one query; None if it is gone
+    appointment = Appointment.objects.select_related(
+        'service__company__companyprofile', 'location', 'professional', 'customer'
+    ).filter(pk=appointment_id).first()
+    if appointment is None:
+        return None
+
+    company = appointment.service.company
+    company_profile = company.companyprofile
+    customer = appointment.customer
+    # Local wall-clock times, as the booking form submitted them
+    start = timezone.localtime(appointment.start).replace(tzinfo=None)
+    end = timezone.localtime(appointment.end).replace(tzinfo=None)
+    return {
+        'customer_email': customer.email,
+        "customer_full_name": customer.full_name,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "company_email": company.email,
+        "company_phone": company.phone,
+        "company_address": company_profile.address,
+        "company_name": company_profile.name,
+        "customer_phone": customer.phone,
+        "service_duration": duration(appointment.service.duration),
+        "service_description": appointment.service.description,
+        "service_name": appointment.service.name,
+        "date": start.date().isoformat(),
+        "time": start.time().isoformat(),
+        "professional_name": appointment.professional.name,
+        "calendar_id": company_profile.calendar_id,
+        "start_isoformat": start.isoformat(),
+        "end_isoformat": end.isoformat(),
+        "google_credentials": company_profile.google_credentials,
+        "location_is_virtual": appointment.location.is_virtual,
+        "reviews_link": company_profile.reviews_link
+    }
+
+
+def resolve_payload(message, version: int = PAYLOAD_VERSION):
+    # Messages enqueued before PAYLOAD_VERSION 1 still carry the full payload
+    if isinstance(message, dict):
+        return message
+    return build_appointment_payload(message)
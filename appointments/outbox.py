@@ -0,0 +1,50 @@
+import datetime as dt
+
+from celery import current_app
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_RETENTION = dt.timedelta(days=7)
+
+
+def enqueue(task, args=(), eta=None) -> OutboxMessage:
+    # Record a Celery task call in the current transaction. It is published by relay_outbox
+    # only if the transaction commits, so requests never talk to the broker themselves.
+    return OutboxMessage.objects.create(task=task.name, args=list(args), eta=eta)
+
+
+def enqueue_many(calls) -> list:
+    # Same as enqueue for several (task, args, eta) calls, inserted with one query
+    return OutboxMessage.objects.bulk_create([
+        OutboxMessage(task=task.name, args=list(args), eta=eta) for task, args, eta in calls
+    ])
+
+
+def relay_batch(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    # Publish the oldest pending messages in id order and mark them as sent. If publishing
+    # fails the batch is retried as a whole, so delivery is at least once.
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update().filter(sent_at__isnull=True).order_by('id')[:batch_size]
+        )
+        for message in messages:
+            current_app.tasks[message.task].apply_async(args=message.args, eta=message.eta)
+        OutboxMessage.objects.filter(pk__in=[message.pk for message in messages]).update(sent_at=timezone.now())
+    return len(messages)
+
+
+def relay_outbox(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    relayed = 0
+    while True:
+        count = relay_batch(batch_size)
+        relayed += count
+        if count < batch_size:
+            return relayed
+
+
+def purge_sent_messages() -> int:
+    deleted, _ = OutboxMessage.objects.filter(sent_at__lt=timezone.now() - OUTBOX_RETENTION).delete()
+    return deleted
@@ -0,0 +1,136 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CustomPageNumberPagination(PageNumberPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get('get_all', False) == 'true':
+            return None
+        return super().paginate_queryset(queryset, request, view=view)
+
+
+class KeysetPagination(BasePagination):
+    # Pages on (ordering field, id) with WHERE instead of OFFSET and without a count,
+    # so every page costs the same. Cursors are opaque to clients.
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    default_ordering = 'start'
+    invalid_cursor_message = 'Cursor inválido.'
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, request, queryset) -> str:
+        # The ordering chosen by OrderingFilter, or start when the client did not ask for one
+        if self.ordering_query_param in request.query_params and queryset.query.order_by:
+            return queryset.query.order_by[0]
+        return self.default_ordering
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return cursor['v'], cursor['i'], bool(cursor['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance, reverse: bool) -> str:
+        value = instance.keyset_value
+        # isoformat keeps the microseconds that DjangoJSONEncoder would cut
+        cursor = json.dumps({'v': value, 'i': instance.pk, 'r': reverse}, default=lambda value: value.isoformat())
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   base64.urlsafe_b64encode(cursor.encode()).decode())
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        ordering = self.get_ordering(request, queryset)
+        self.field = ordering.lstrip('-')
+        descending = ordering.startswith('-')
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor[2]
+
+        # Walking backwards flips the order and the comparison, then the page is flipped back
+        backwards = descending != reverse
+        prefix = '-' if backwards else ''
+        keys = [self.field, 'id'] if self.field != 'id' else ['id']
+        # Annotated so that cursors do not depend on the fields the serializer loads
+        queryset = queryset.annotate(keyset_value=F(self.field)).order_by(*(prefix + key for key in keys))
+        if cursor is not None:
+            value, pk, _ = cursor
+            lookup = 'lt' if backwards else 'gt'
+            # A tampered cursor can decode to values the fields cannot convert, such as a malformed datetime
+            try:
+                if self.field == 'id':
+                    queryset = queryset.filter(**{f'id__{lookup}': pk})
+                else:
+                    queryset = queryset.filter(Q(**{f'{self.field}__{lookup}': value})
+                                               | Q(**{self.field: value, f'id__{lookup}': pk}))
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class AppointmentPagination(CustomPageNumberPagination):
+    # Page numbers by default; ?pagination=cursor switches to keyset pages
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if request.query_params.get('pagination') == 'cursor':
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view=view)
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
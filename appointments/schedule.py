@@ -0,0 +1,85 @@
+import datetime as dt
+from functools import lru_cache
+from typing import NamedTuple
+
+from app.cache import get_version
+from .models import Service
+
+
+class Window(NamedTuple):
+    id: int
+    weekday: int
+    start_time: dt.time
+    end_time: dt.time
+
+
+class ScheduleTemplate(NamedTuple):
+    service_id: int
+    version: int
+    duration: dt.timedelta
+    time_between_appointments: dt.timedelta
+    windows: tuple
+    # Sorted slot start offsets (seconds since midnight), indexed by weekday id
+    slots: tuple
+
+    def weekday_slots(self, weekday: int) -> tuple:
+        return self.slots[weekday]
+
+    def is_slot(self, start: dt.datetime) -> bool:
+        return to_seconds(start.time()) in self.slots[start.weekday()]
+
+    def timeframes_data(self) -> list:
+        # Same shape as TimeFrameSerializer output
+        return [
+            {
+                'id': window.id,
+                'start_time': window.start_time.isoformat(),
+                'end_time': window.end_time.isoformat(),
+                'weekday': window.weekday,
+            }
+            for window in self.windows
+        ]
+
+
+def to_seconds(time: dt.time) -> int:
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def slot_grid(windows, step: int) -> list:
+    # Candidate slot starts of every (start, end) window, stepping by duration plus gap
+    slots = set()
+    for start, end in windows:
+        slots.update(range(start, end, step))
+    return sorted(slots)
+
+
+@lru_cache(maxsize=1024)
+def compile_schedule_template(service_id: int, version: int) -> ScheduleTemplate:
+    service = Service.objects.prefetch_related('timeframe_set').get(pk=service_id)
+    timeframes = sorted(service.timeframe_set.all(), key=lambda timeframe: (timeframe.weekday_id, timeframe.start_time))
+    windows = tuple(
+        Window(timeframe.id, timeframe.weekday_id, timeframe.start_time, timeframe.end_time)
+        for timeframe in timeframes
+    )
+    step = int((service.duration + service.time_between_appointments).total_seconds())
+    slots = tuple(
+        tuple(slot_grid(
+            [(to_seconds(window.start_time), to_seconds(window.end_time)) for window in windows if window.weekday == weekday],
+            step,
+        ))
+        for weekday in range(7)
+    )
+    return ScheduleTemplate(
+        service_id=service.id,
+        version=version,
+        duration=service.duration,
+        time_between_appointments=service.time_between_appointments,
+        windows=windows,
+        slots=slots,
+    )
+
+
+def get_schedule_template(service_id: int) -> ScheduleTemplate:
+    # Memoized per process by service id and version. Service and TimeFrame changes
+    # bump the version, so stale templates are never read again and age out of the LRU.
+    return compile_schedule_template(service_id, get_version(f'service:{service_id}'))
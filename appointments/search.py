@@ -0,0 +1,85 @@
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+
+from .models import SEARCH_DOCUMENT_FIELDS, Appointment
+
+APPOINTMENT_TABLE = Appointment._meta.db_table
+FTS_TABLE = f'{APPOINTMENT_TABLE}_fts'
+TRIGRAM_INDEX = 'appt_search_document_trgm_idx'
+# The trigram tokenizer cannot match shorter terms, which fall back to LIKE
+MIN_FTS_TERM_LENGTH = 3
+SEARCH_RELATIONS = sorted({path.split('__')[0] for path in SEARCH_DOCUMENT_FIELDS})
+
+# External content FTS5 table over search_document, kept in sync by triggers
+SQLITE_STATEMENTS = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"search_document, content='{APPOINTMENT_TABLE}', content_rowid='id', tokenize='trigram')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {APPOINTMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, search_document) VALUES (new.id, new.search_document); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {APPOINTMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_document) "
+    f"VALUES ('delete', old.id, old.search_document); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF search_document ON {APPOINTMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_document) "
+    f"VALUES ('delete', old.id, old.search_document); "
+    f"INSERT INTO {FTS_TABLE}(rowid, search_document) VALUES (new.id, new.search_document); END",
+]
+
+# Trigram GIN index, which serves LIKE '%term%'
+POSTGRES_STATEMENTS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} ON {APPOINTMENT_TABLE} USING gin (search_document gin_trgm_ops)",
+]
+
+
+def install_search_index(using: str = 'default', **kwargs):
+    # post_migrate handler; the index lives outside the models because Django cannot declare it
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+            created = cursor.fetchone() is None
+            for statement in SQLITE_STATEMENTS:
+                cursor.execute(statement)
+            if created:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        elif connection.vendor == 'postgresql':
+            for statement in POSTGRES_STATEMENTS:
+                cursor.execute(statement)
+
+
+def search_condition(term: str, vendor: str) -> Q:
+    term = term.lower()
+    if vendor == 'sqlite' and len(term) >= MIN_FTS_TERM_LENGTH:
+        phrase = '"' + term.replace('"', '""') + '"'
+        return Q(id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [phrase]))
+    # The document is stored lowercased, so a plain LIKE is case-insensitive and Postgres can use the trigram index
+    return Q(search_document__contains=term)
+
+
+def refresh_search_documents(queryset, batch_size: int = 1000) -> int:
+    # Rewrite the stale documents of the given appointments; returns how many changed
+    changed = []
+    for appointment in queryset.select_related(*SEARCH_RELATIONS).order_by('id').iterator(chunk_size=batch_size):
+        document = appointment.get_search_document()
+        if document != appointment.search_document:
+            appointment.search_document = document
+            changed.append(appointment)
+    Appointment._base_manager.bulk_update(changed, ['search_document'], batch_size=batch_size)
+    return len(changed)
+
+
+class AppointmentSearchFilter(filters.SearchFilter):
+    # Same ?search= terms as SearchFilter (every term must match some field), matched
+    # against Appointment.search_document instead of LIKE over four joined tables
+
+    def get_search_fields(self, view, request):
+        return SEARCH_DOCUMENT_FIELDS
+
+    def filter_queryset(self, request, queryset, view):
+        vendor = connections[queryset.db].vendor
+        for term in self.get_search_terms(request):
+            queryset = queryset.filter(search_condition(term, vendor))
+        return queryset
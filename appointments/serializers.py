@@ -2,8 +2,10 @@ import datetime
 
 from rest_framework import serializers
 
+from accounts.models import Customer
 from accounts.serializers import CustomerSerializer
 from appointments.models import *
+from appointments.schedule import get_schedule_template
 
 
 class AppointmentSerializer(serializers.ModelSerializer):
@@ -16,17 +18,60 @@ class AppointmentSerializer(serializers.ModelSerializer):
     location_name = serializers.CharField(source='location.name', read_only=True)
     professional_name = serializers.CharField(source='professional.name', read_only=True)
     title = serializers.SerializerMethodField()
-    company = serializers.IntegerField(source='service.company.id', read_only=True)
+    company = serializers.IntegerField(source='service.company_id', read_only=True)
+
+    # Columns read by the fields that are not plain model fields, for QuerySet.only()
+    related_columns = {
+        'customer': [f'customer__{field.name}' for field in Customer._meta.concrete_fields
+                     if field.name not in CustomerSerializer.Meta.exclude],
+        'customer_name': ['customer__first_name', 'customer__last_name'],
+        'service_name': ['service__name'],
+        'location_name': ['location__name'],
+        'professional_name': ['professional__name'],
+        'title': ['service__name', 'customer__first_name', 'customer__last_name'],
+        'company': ['service__company_id'],
+    }
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sparse fieldset: keep only the given fields
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
     def get_title(self, obj):
         return f"{obj.service.name} - {obj.customer.full_name}"
 
+    def validate(self, data):
+        # Overlap filters only look MAX_APPOINTMENT_DURATION back for appointments that run into a window
+        start = data.get('start', getattr(self.instance, 'start', None))
+        end = data.get('end', getattr(self.instance, 'end', None))
+        if start and end and not start < end <= start + MAX_APPOINTMENT_DURATION:
+            hours = int(MAX_APPOINTMENT_DURATION.total_seconds() // 3600)
+            raise serializers.ValidationError({
+                'end': f'La cita debe terminar después de su inicio y durar como máximo {hours} horas',
+            })
+        return data
+
+    def get_columns(self) -> list:
+        # Lookups for QuerySet.only() that cover the selected fields, the relations to join included
+        columns = ['id']
+        for name, field in self.fields.items():
+            columns += self.related_columns.get(name, [field.source])
+        return list(dict.fromkeys(columns))
+
     class Meta:
         model = Appointment
-        fields = '__all__'
+        exclude = ['search_document']
         # extra fields
 
 
+class BookingAppointmentSerializer(AppointmentSerializer):
+    class Meta(AppointmentSerializer.Meta):
+        # Slot conflicts are checked under a lock by booking.create_appointment and answered with a 409
+        validators = []
+
+
 class ServiceSerializer(serializers.ModelSerializer):
     timeframes = serializers.SerializerMethodField()
     additional_questions = serializers.SerializerMethodField()
@@ -34,7 +79,7 @@ class ServiceSerializer(serializers.ModelSerializer):
     def get_additional_questions(self, obj):
         return AdditionalQuestionSerializer(obj.additionalquestion_set.all(), many=True).data
     def get_timeframes(self, obj):
-        return TimeFrameSerializer(obj.timeframe_set.all(), many=True).data
+        return get_schedule_template(obj.id).timeframes_data()
 
     class Meta:
         model = Service
@@ -0,0 +1,74 @@
+import datetime as dt
+from bisect import bisect_left
+from itertools import islice
+
+from dateutil.rrule import rrulestr
+from django.utils import timezone
+
+from .availability import SECONDS_PER_DAY, busy_intervals_by_date
+from .models import Appointment, overlapping
+from .schedule import to_seconds
+
+MAX_SERIES_OCCURRENCES = 52
+
+# Occurrences are reminded this long before they start rather than right after booking
+SERIES_REMINDER_LEAD_TIME = dt.timedelta(days=1)
+
+CONFLICT_MESSAGES = {
+    'past': 'La fecha ya pasó.',
+    'outside_schedule': 'La hora no está dentro del horario del servicio.',
+    'overlaps_series': 'Se cruza con otra cita de la serie.',
+    'busy': 'El profesional ya tiene una cita en este horario.',
+}
+
+
+class InvalidRule(ValueError):
+    pass
+
+
+def expand_rule(rule: str, start: dt.datetime) -> list:
+    # Naive local occurrence starts of an RFC 5545 RRULE such as FREQ=WEEKLY;COUNT=12
+    try:
+        occurrences = list(islice(rrulestr(rule, dtstart=start), MAX_SERIES_OCCURRENCES + 1))
+    except (ValueError, TypeError) as e:
+        raise InvalidRule(str(e)) from e
+    if not occurrences or len(occurrences) > MAX_SERIES_OCCURRENCES:
+        raise InvalidRule(f'A series must have between 1 and {MAX_SERIES_OCCURRENCES} occurrences')
+    return occurrences
+
+
+def overlaps(busy: list, start: int, end: int) -> bool:
+    # busy is a merged, sorted interval list; only the last interval starting before end can overlap
+    index = bisect_left(busy, [end]) - 1
+    return index >= 0 and busy[index][1] > start
+
+
+def check_occurrences(professional_id: int, template, occurrences: list) -> list:
+    # (start, conflict reason or None) for every occurrence, loading the professional's
+    # appointments for the whole series with one query
+    starts = [timezone.make_aware(occurrence) for occurrence in occurrences]
+    appointments = Appointment.objects.filter(
+        overlapping(starts[0], starts[-1] + template.duration), professional_id=professional_id
+    ).only('start', 'end')
+    busy = busy_intervals_by_date(appointments)
+
+    now = timezone.now()
+    results = []
+    previous_end = None
+    for occurrence, start in zip(occurrences, starts):
+        end = occurrence + template.duration
+        end_seconds = to_seconds(end.time()) if end.date() == occurrence.date() else SECONDS_PER_DAY
+        reason = None
+        if start <= now:
+            reason = 'past'
+        elif not template.is_slot(occurrence):
+            reason = 'outside_schedule'
+        elif previous_end is not None and occurrence < previous_end:
+            reason = 'overlaps_series'
+        elif overlaps(busy.get(occurrence.date(), []), to_seconds(occurrence.time()), end_seconds):
+            reason = 'busy'
+        if reason is None:
+            previous_end = end
+        results.append((start, reason))
+    return results
+
@@ -0,0 +1,147 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from accounts.models import CompanyProfile, Customer
+from app.cache import bump_version
+from .availability import local_dates, rebuild_available_times
+from .catalog import invalidate_catalog, service_company_id
+from .models import AdditionalQuestion, Appointment, DailyCompanyStats, Location, Professional, Service, TimeFrame
+from .outbox import enqueue
+from .stats import refresh_appointment_stats
+from .tasks import refresh_appointment_search_documents
+
+
+@receiver([post_save, post_delete], sender=Appointment)
+def rebuild_availability_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    affected = {}
+    loaded = getattr(instance, '_loaded_values', {})
+    for professional_id, start, end in [
+        (loaded.get('professional_id'), loaded.get('start'), loaded.get('end')),
+        (instance.professional_id, instance.start, instance.end),
+    ]:
+        if professional_id and start and end:
+            affected.setdefault(professional_id, set()).update(local_dates(start, end))
+    rebuild_availability_on_commit(affected)
+
+
+def rebuild_availability_on_commit(affected: dict):
+    # {professional_id: local dates}, rebuilt once the transaction commits
+    for professional_id, dates in affected.items():
+        transaction.on_commit(lambda professional_id=professional_id, dates=dates:
+                              rebuild_available_times(professional_id, dates))
+
+
+@receiver([post_save, post_delete], sender=TimeFrame)
+@receiver([post_save, post_delete], sender=Service)
+def invalidate_service_availability(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    service_id = instance.service_id if sender is TimeFrame else instance.id
+    # After commit, so a request racing the transaction cannot cache old slots under the new version
+    transaction.on_commit(lambda: bump_version(f'service:{service_id}'))
+
+
+def invalidate_company_stats(company_id: int):
+    # After commit, so a request racing the transaction cannot cache old figures under the new version
+    transaction.on_commit(lambda: bump_version(f'stats:{company_id}'))
+
+
+@receiver([post_save, post_delete], sender=Appointment)
+def refresh_stats_rollup(sender, instance, raw=False, **kwargs):
+    # Runs in the saving transaction so the rollup commits or rolls back with the appointment
+    if raw:
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    companies = refresh_appointment_stats({
+        (loaded.get('service_id'), loaded.get('professional_id'), loaded.get('customer_id'), loaded.get('start')),
+        (instance.service_id, instance.professional_id, instance.customer_id, instance.start),
+    })
+    for company_id in companies:
+        invalidate_company_stats(company_id)
+
+
+def refresh_created_appointments(appointments):
+    # bulk_create skips post_save, so do the work of the receivers above once for all the rows
+    # instead of sending the signal per row
+    affected = {}
+    for appointment in appointments:
+        affected.setdefault(appointment.professional_id, set()).update(local_dates(appointment.start, appointment.end))
+    rebuild_availability_on_commit(affected)
+    companies = refresh_appointment_stats({
+        (appointment.service_id, appointment.professional_id, appointment.customer_id, appointment.start)
+        for appointment in appointments
+    })
+    for company_id in companies:
+        invalidate_company_stats(company_id)
+
+
+@receiver(post_save, sender=Service)
+def refresh_service_revenue(sender, instance, raw=False, **kwargs):
+    # Revenue is valued at the current price, as the stats always were
+    if raw:
+        return
+    DailyCompanyStats.objects.filter(service=instance).update(revenue=F('appointments') * instance.price)
+
+
+@receiver([post_save, post_delete], sender=Professional)
+@receiver([post_save, post_delete], sender=Service)
+def invalidate_catalog_stats(sender, instance, raw=False, **kwargs):
+    # Names label the pivot columns and prices value the revenue
+    if raw:
+        return
+    invalidate_company_stats(instance.company_id)
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=Professional)
+@receiver(post_save, sender=Service)
+def refresh_search_documents_on_rename(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    if sender is Customer:
+        # Customers do not keep their loaded values; the first name opens every document
+        stale = Appointment._base_manager.filter(customer=instance).exclude(
+            search_document__startswith=f'{instance.first_name or ""}\n'.lower()).exists()
+        if not stale:
+            return
+    elif getattr(instance, '_loaded_values', {}).get('name') == instance.name:
+        return
+    relation = sender._meta.model_name
+    enqueue(refresh_appointment_search_documents, (relation, instance.pk))
+
+
+@receiver([post_save, post_delete], sender=CompanyProfile)
+@receiver([post_save, post_delete], sender=Location)
+@receiver([post_save, post_delete], sender=Professional)
+@receiver([post_save, post_delete], sender=Service)
+def invalidate_company_catalog(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is Service:
+        cache.delete(f'catalog:service:{instance.id}')
+    elif sender is CompanyProfile:
+        # The slug may now belong to this company
+        cache.delete(f'catalog:slug:{instance.slug}')
+    invalidate_catalog(instance.company_id)
+
+
+@receiver([post_save, post_delete], sender=AdditionalQuestion)
+@receiver([post_save, post_delete], sender=TimeFrame)
+def invalidate_service_catalog(sender, instance, raw=False, **kwargs):
+    # Questions and timeframes are served within their service
+    if raw:
+        return
+    invalidate_catalog(service_company_id(instance.service_id))
+
+
+@receiver(m2m_changed, sender=Professional.services.through)
+def invalidate_professional_services_catalog(sender, instance, action, **kwargs):
+    # Professionals are filtered by service and locations by the services of their professionals
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_catalog(instance.company_id)
@@ -0,0 +1,210 @@
+import datetime as dt
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min, Q, Sum
+from django.db.models.functions import TruncDate, TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from accounts.models import Company
+from app.cache import HitCounter, bump_version, get_version
+from .models import Appointment, CompanyCustomer, DailyCompanyStats, Professional, Service
+
+# Value of a date x service revenue cell, and of revenue_this_month, when there are no appointments
+MISSING_REVENUE = 1_000_000
+
+# Rollup dates are local (America/Bogota) dates, so truncating them needs no timezone
+GRANULARITIES = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+
+STATS_CACHE_TIMEOUT = 86400
+
+stats_counter = HitCounter('stats')
+
+
+def bucket_aggregates() -> dict:
+    # Columns of DailyCompanyStats, computed over the appointments of one bucket
+    return {
+        'appointments': Count('id'),
+        'completed': Count('id', filter=Q(is_complete=True)),
+        'revenue': Sum('service__price'),
+        'customers': Count('customer_id', distinct=True),
+    }
+
+
+def local_day_start(date: dt.date) -> dt.datetime:
+    return timezone.make_aware(dt.datetime.combine(date, dt.time.min))
+
+
+def refresh_daily_buckets(buckets):
+    # Recount (company_id, service_id, professional_id, date) buckets with one aggregate query and one upsert;
+    # recounted rather than incremented so distinct customers stay exact
+    if not buckets:
+        return
+    condition = Q()
+    for _, service_id, professional_id, date in buckets:
+        condition |= Q(service_id=service_id, professional_id=professional_id,
+                       start__gte=local_day_start(date), start__lt=local_day_start(date + dt.timedelta(days=1)))
+    rows = Appointment.objects.filter(condition).annotate(date=TruncDate('start')).values(
+        'service_id', 'professional_id', 'date').annotate(**bucket_aggregates()).order_by()
+    totals = {(row.pop('service_id'), row.pop('professional_id'), row.pop('date')): row for row in rows}
+    counted = []
+    empty = Q()
+    for company_id, service_id, professional_id, date in buckets:
+        bucket = {'company_id': company_id, 'service_id': service_id, 'professional_id': professional_id, 'date': date}
+        if (service_id, professional_id, date) in totals:
+            counted.append(DailyCompanyStats(**bucket, **totals[(service_id, professional_id, date)]))
+        else:
+            empty |= Q(**bucket)
+    if empty:
+        DailyCompanyStats.objects.filter(empty).delete()
+    DailyCompanyStats.objects.bulk_create(
+        counted, update_conflicts=True, unique_fields=['company', 'date', 'service', 'professional'],
+        update_fields=list(bucket_aggregates()))
+
+
+def refresh_company_customer(company_id: int, customer_id: int):
+    first_appointment = Appointment.objects.filter(
+        service__company_id=company_id, customer_id=customer_id
+    ).aggregate(first=Min('start'))['first']
+    if first_appointment is None:
+        CompanyCustomer.objects.filter(company_id=company_id, customer_id=customer_id).delete()
+        return
+    CompanyCustomer.objects.update_or_create(company_id=company_id, customer_id=customer_id,
+                                             defaults={'first_appointment': first_appointment})
+
+
+def refresh_appointment_stats(states) -> set:
+    # states: (service_id, professional_id, customer_id, start) of appointments before and after a change;
+    # returns the ids of the companies whose stats changed
+    states = [state for state in states if all(state)]
+    if not states:
+        return set()
+    # Inactive services keep their stats, and a service deleted in cascade has nothing left to refresh
+    companies = dict(Service._base_manager.filter(pk__in={state[0] for state in states})
+                     .values_list('id', 'company_id'))
+    buckets = set()
+    customers = set()
+    for service_id, professional_id, customer_id, start in states:
+        if service_id not in companies:
+            continue
+        company_id = companies[service_id]
+        buckets.add((company_id, service_id, professional_id, timezone.localdate(start)))
+        customers.add((company_id, customer_id))
+    refresh_daily_buckets(buckets)
+    for company_id, customer_id in customers:
+        refresh_company_customer(company_id, customer_id)
+    return {company_id for company_id, _ in customers}
+
+
+def rebuild_company_stats(company_id: int) -> int:
+    # Recompute the rollup of a company from its appointments; returns the number of buckets
+    appointments = Appointment.objects.filter(service__company_id=company_id)
+    buckets = appointments.annotate(date=TruncDate('start')).values(
+        'date', 'service_id', 'professional_id').annotate(**bucket_aggregates()).order_by()
+    customers = appointments.values('customer_id').annotate(first_appointment=Min('start')).order_by()
+    with transaction.atomic():
+        DailyCompanyStats.objects.filter(company_id=company_id).delete()
+        CompanyCustomer.objects.filter(company_id=company_id).delete()
+        created = DailyCompanyStats.objects.bulk_create(
+            (DailyCompanyStats(company_id=company_id, **bucket) for bucket in buckets), batch_size=1000)
+        CompanyCustomer.objects.bulk_create(
+            (CompanyCustomer(company_id=company_id, **customer) for customer in customers), batch_size=1000)
+        transaction.on_commit(lambda: bump_version(f'stats:{company_id}'))
+    return len(created)
+
+
+def pivot(rows, column_key: str, value_key: str, dates: list, columns: list, default) -> list:
+    # [["Date", *columns], [date, value, ...], ...] from aggregated rows via dict lookups
+    values = {(row['period'], row[column_key]): row[value_key] for row in rows}
+    table = [["Date"] + list(columns)]
+    for date in dates:
+        table.append([date] + [values.get((date, column), default) for column in columns])
+    return table
+
+
+def month_bounds(date: dt.date) -> tuple:
+    # Half-open [first day, first day of the next month)
+    first = date.replace(day=1)
+    return first, (first + dt.timedelta(days=32)).replace(day=1)
+
+
+def compute_company_stats(company, date_from: dt.date = None, date_to: dt.date = None,
+                          granularity: str = 'day') -> dict:
+    # Pivot tables and totals cover [date_from, date_to] in local dates, all of time by default.
+    # Pivot rows are days, weeks (dated on Monday) or months (dated on the 1st).
+    today = timezone.localdate()
+    month_start, next_month_start = month_bounds(today)
+    stats = {}
+
+    rollup = DailyCompanyStats.objects.filter(company=company)
+    period_rollup = rollup
+    if date_from:
+        period_rollup = period_rollup.filter(date__gte=date_from)
+    if date_to:
+        period_rollup = period_rollup.filter(date__lt=date_to + dt.timedelta(days=1))
+    periods = period_rollup.annotate(period=GRANULARITIES[granularity]('date'))
+    services = list(Service.objects.filter(company=company).values_list('name', flat=True))
+    professionals = list(Professional.objects.filter(company=company).values_list('name', flat=True))
+
+    per_service_per_date = list(periods.values('period', 'service__name').annotate(
+        count=Sum('appointments'), revenue=Sum('revenue')))
+    per_professional_per_date = list(periods.values('period', 'professional__name').annotate(
+        count=Sum('appointments')))
+    per_service = {
+        row['service__name']: row['count']
+        for row in period_rollup.values('service__name').annotate(count=Sum('appointments'))
+    }
+    dates = sorted({row['period'] for row in per_service_per_date})
+
+    stats['appointments_per_service_per_date'] = pivot(
+        per_service_per_date, 'service__name', 'count', dates, services, 0)
+    stats['appointments_per_service'] = [["Service", "Count"]] + [
+        [service, per_service.get(service, 0)] for service in services
+    ]
+    stats['revenue_per_service_per_date'] = pivot(
+        per_service_per_date, 'service__name', 'revenue', dates, services, MISSING_REVENUE)
+    stats['appointments_per_professional_per_date'] = pivot(
+        per_professional_per_date, 'professional__name', 'count', dates, professionals, 0)
+
+    # Range on the indexed (company, date) prefix rather than a month() call per row
+    this_month = rollup.filter(date__gte=month_start, date__lt=next_month_start).aggregate(
+        revenue=Sum('revenue'), count=Sum('appointments'))
+    stats['revenue_this_month'] = this_month['revenue'] or MISSING_REVENUE
+    stats['appointments_this_month'] = this_month['count'] or 0
+
+    # A customer is new in the month of their first appointment with the company;
+    # the total is the customer base at the end of the period
+    period_end = date_to + dt.timedelta(days=1) if date_to else next_month_start
+    customers = CompanyCustomer.objects.filter(company=company).aggregate(
+        total=Count('id', filter=Q(first_appointment__lt=local_day_start(period_end))),
+        new=Count('id', filter=Q(first_appointment__gte=local_day_start(month_start),
+                                 first_appointment__lt=local_day_start(next_month_start))),
+    )
+    stats['new_customers_this_month'] = customers['new']
+
+    totals = period_rollup.aggregate(revenue=Sum('revenue'), count=Sum('appointments'))
+    stats['total_revenue'] = totals['revenue'] or 0
+    stats['total_appointments'] = totals['count'] or 0
+    stats['total_customers'] = customers['total']
+    return stats
+
+
+def stats_cache_key(company_id: int, date_from: dt.date = None, date_to: dt.date = None,
+                    granularity: str = 'day') -> str:
+    # Appointment, service and professional changes bump the company version;
+    # today is part of the key because the "this month" figures roll over at midnight
+    version = get_version(f'stats:{company_id}')
+    period = f'{date_from or ""}:{date_to or ""}:{granularity}'
+    return f'stats:{version}:{company_id}:{timezone.localdate().isoformat()}:{period}'
+
+
+def get_cached_company_stats(key: str, company_id: int, date_from: dt.date = None, date_to: dt.date = None,
+                             granularity: str = 'day') -> dict:
+    stats = cache.get(key)
+    if stats is None:
+        stats_counter.miss()
+        stats = compute_company_stats(Company.objects.get(pk=company_id), date_from, date_to, granularity)
+        cache.set(key, stats, timeout=STATS_CACHE_TIMEOUT)
+    else:
+        stats_counter.hit()
+    return stats
@@ -3,11 +3,16 @@ from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from celery import shared_task
-from appointments.models import Appointment
+from appointments import outbox
+from appointments.idempotency import purge_expired_keys
+from appointments.models import Appointment, AppointmentSeries
+from appointments.notifications import PAYLOAD_VERSION, resolve_payload
+from appointments.search import refresh_search_documents
 from app.settings import EMAIL_ADMIN
 from django.conf import settings
 from django.template.loader import get_template
 from django.core.mail import EmailMessage
+from django.utils import timezone
 
 
 def send_email(subject, template, context, recipient,
@@ -26,9 +31,9 @@ def send_email(subject, template, context, recipient,
 
 
 @shared_task
-def new_appointment_notify_customer(instance):
-    print("Sending email")
-    if not instance["customer_email"]:
+def new_appointment_notify_customer(appointment_id, version=PAYLOAD_VERSION):
+    instance = resolve_payload(appointment_id, version)
+    if instance is None or not instance["customer_email"]:
         return
     send_email(
         subject=f"¡Nueva reserva confirmada! - {instance['customer_full_name']} | {instance['start']}",
@@ -39,8 +44,10 @@ def new_appointment_notify_customer(instance):
 
 
 @shared_task
-def new_appointment_notify_company(instance):
-    print("Sending email")
+def new_appointment_notify_company(appointment_id, version=PAYLOAD_VERSION):
+    instance = resolve_payload(appointment_id, version)
+    if instance is None:
+        return
     send_email(
         subject=f"¡Nueva reserva confirmada! - {instance['customer_full_name']} |  {instance['start']}",
         template="appointments/new_appointment_company.html",
@@ -50,7 +57,10 @@ def new_appointment_notify_company(instance):
 
 
 @shared_task
-def new_appointment_add_to_calendar(instance):
+def new_appointment_add_to_calendar(appointment_id, version=PAYLOAD_VERSION):
+    instance = resolve_payload(appointment_id, version)
+    if instance is None:
+        return
     user_credentials = instance["google_credentials"]
     if not user_credentials or not instance["customer_email"]:
         return
@@ -92,7 +102,10 @@ def new_appointment_add_to_calendar(instance):
         body=event, conferenceDataVersion=1).execute()
 
 @shared_task
-def send_reminder_email(instance):
+def send_reminder_email(appointment_id, version=PAYLOAD_VERSION):
+    instance = resolve_payload(appointment_id, version)
+    if instance is None:
+        return
     send_email(
         subject=f"¡Recuerda tu cita! - {instance['customer_full_name']} | {instance['start']}",
         template="appointments/appointment_reminder.html",
@@ -101,10 +114,64 @@ def send_reminder_email(instance):
     )
 
 @shared_task
-def send_review_email(instance):
+def send_review_email(appointment_id, version=PAYLOAD_VERSION):
+    instance = resolve_payload(appointment_id, version)
+    if instance is None:
+        return
     send_email(
         subject="¡Calificanos!",
         template="appointments/service_review.html",
         context={'appointment': instance},
         recipient=[instance["customer_email"]],
     )
+
+
+@shared_task
+def new_appointment_series_notify(series_id):
+    # One email to the customer and one to the company for the whole series
+    series = AppointmentSeries.objects.select_related('customer').get(pk=series_id)
+    appointments = list(
+        series.appointments.select_related('service__company__companyprofile', 'professional', 'location')
+        .order_by('start')
+    )
+    if not appointments:
+        return
+    first = appointments[0]
+    context = {
+        'series': series,
+        'customer_full_name': series.customer.full_name,
+        'service_name': first.service.name,
+        'service_duration': first.service.duration,
+        'professional_name': first.professional.name,
+        'company_name': first.service.company.companyprofile.name,
+        'company_address': first.service.company.companyprofile.address,
+        'company_phone': first.service.company.phone,
+        'appointments': [timezone.localtime(appointment.start) for appointment in appointments],
+    }
+    subject = f"¡Nuevas reservas confirmadas! - {context['customer_full_name']} | {len(appointments)} citas"
+    if series.customer.email:
+        send_email(subject=subject, template="appointments/new_appointment_series.html",
+                   context=dict(context), recipient=[series.customer.email])
+    send_email(subject=subject, template="appointments/new_appointment_series.html",
+               context=dict(context), recipient=[first.service.company.email])
+
+
+@shared_task
+def purge_idempotency_keys():
+    return purge_expired_keys()
+
+
+@shared_task
+def relay_outbox():
+    return outbox.relay_outbox()
+
+
+@shared_task
+def purge_outbox():
+    return outbox.purge_sent_messages()
+
+
+@shared_task
+def refresh_appointment_search_documents(relation, pk):
+    # Run after a customer, location, service or professional is renamed
+    return refresh_search_documents(Appointment._base_manager.filter(**{f'{relation}_id': pk}))
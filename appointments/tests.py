@@ -1 +1,870 @@
-# Create your tests here.
+import base64
+import datetime as dt
+import io
+import json
+import uuid
+from array import array
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from accounts.models import Company, CompanyProfile, Customer
+from app.parsers import ORJSONParser
+from app.renderers import ORJSONRenderer
+from .availability import availability_cache_key, available_slots, find_next_available, \
+    get_available_times_range, get_cached_available_times, get_service_available_times
+from .export import EXPORT_COLUMNS
+from .idempotency import get_stored_response
+from .models import MAX_APPOINTMENT_DURATION, AdditionalQuestion, Appointment, CompanyCustomer, DailyCompanyStats, \
+    Location, OutboxMessage, Professional, Service, TimeFrame, WeekDay
+from .notifications import build_appointment_payload, resolve_payload
+from .outbox import OUTBOX_RETENTION, relay_outbox
+from .serializers import AppointmentSerializer
+from .series import MAX_SERIES_OCCURRENCES
+from .stats import rebuild_company_stats
+from .tasks import purge_outbox
+
+
+class AppointmentListQueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create_user(email='company@example.com', first_name='Company', last_name='Test')
+        location = Location.objects.create(name='Main', address='Main', phone='0', company=cls.company)
+        service = Service.objects.create(name='Service', price=100, duration=dt.timedelta(minutes=30),
+                                         time_between_appointments=dt.timedelta(0), company=cls.company)
+        professionals = [
+            Professional.objects.create(name=f'Professional {index}', company=cls.company, location=location)
+            for index in range(3)
+        ]
+        customers = [
+            Customer.objects.create_user(email=f'customer{index}@example.com', first_name='Customer',
+                                         last_name=str(index))
+            for index in range(5)
+        ]
+        start = timezone.now() + dt.timedelta(days=1)
+        for index in range(30):
+            Appointment.objects.create(
+                location=location, service=service, professional=professionals[index % 3],
+                customer=customers[index % 5], start=start + dt.timedelta(hours=index),
+                end=start + dt.timedelta(hours=index, minutes=30),
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.company)
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        for page_size in [1, 10, 30]:
+            with self.subTest(page_size=page_size), self.assertNumQueries(2):
+                response = self.client.get('/api/appointments/', {'page_size': page_size})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), page_size)
+
+    def test_list_fields(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/appointments/', {'get_all': 'true'})
+        appointment = response.data[0]
+        self.assertEqual(len(response.data), 30)
+        self.assertEqual(appointment['company'], self.company.id)
+        self.assertEqual(appointment['title'], 'Service - Customer 0')
+        self.assertEqual(appointment['professional_name'], 'Professional 0')
+        self.assertEqual(appointment['customer']['email'], 'customer0@example.com')
+
+    def test_calendar_view_reads_only_its_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/appointments/', {'view': 'calendar', 'get_all': 'true'})
+        appointment = response.data[0]
+        self.assertEqual(set(appointment), {'id', 'start', 'end', 'title', 'professional'})
+        self.assertEqual(appointment['title'], 'Service - Customer 0')
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertNotIn('"email"', sql)
+        self.assertNotIn('appointments_location', sql)
+        self.assertNotIn('appointments_professional', sql)
+
+    def test_sparse_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/appointments/', {'fields': 'id,start', 'page_size': 5})
+        self.assertEqual([set(appointment) for appointment in response.data['results']], [{'id', 'start'}] * 5)
+        self.assertNotIn('appointments_professional', queries[-1]['sql'])
+        self.assertNotIn('accounts_user', queries[-1]['sql'])
+
+        response = self.client.get('/api/appointments/', {'fields': 'id,professional_name,customer'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'professional_name', 'customer'})
+        self.assertEqual(response.data['results'][0]['customer']['email'], 'customer0@example.com')
+
+        response = self.client.get('/api/appointments/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_matches_related_names(self):
+        def search(term):
+            response = self.client.get('/api/appointments/', {'search': term, 'get_all': 'true'})
+            return sorted(appointment['id'] for appointment in response.data)
+
+        appointments = Appointment.objects.order_by('id')
+        self.assertEqual(search('PROFESSIONAL 1'), list(appointments.filter(
+            professional__name='Professional 1').values_list('id', flat=True)))
+        self.assertEqual(search('customer main 2'), list(appointments.filter(
+            professional__name='Professional 2').values_list('id', flat=True)))
+        self.assertEqual(search('ervic'), list(appointments.values_list('id', flat=True)))
+        self.assertEqual(search('nobody'), [])
+
+    def walk(self, params: dict, link: str = 'next') -> list:
+        pages = []
+        response = self.client.get('/api/appointments/', {'pagination': 'cursor', 'page_size': 7, **params})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append([appointment['id'] for appointment in response.data['results']])
+            if not response.data[link]:
+                return pages
+            with self.assertNumQueries(1):
+                response = self.client.get(response.data[link])
+
+    def test_keyset_pages_follow_the_ordering(self):
+        appointments = Appointment.objects.order_by('start', 'id')
+        pages = self.walk({})
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 7, 2])
+        self.assertEqual(sum(pages, []), list(appointments.values_list('id', flat=True)))
+
+        ordered = self.walk({'ordering': '-professional__name'})
+        expected = appointments.order_by('-professional__name', '-id').values_list('id', flat=True)
+        self.assertEqual(sum(ordered, []), list(expected))
+        self.assertEqual(self.walk({'ordering': '-professional__name', 'fields': 'id'}), ordered)
+
+    def test_keyset_previous_pages(self):
+        pages = self.walk({})
+        response = self.client.get('/api/appointments/', {'pagination': 'cursor', 'page_size': 7})
+        for _ in range(len(pages) - 1):
+            response = self.client.get(response.data['next'])
+        last_page = self.client.get(response.data['previous'])
+        self.assertEqual([appointment['id'] for appointment in last_page.data['results']], pages[-2])
+
+    def test_tampered_cursor_is_not_found(self):
+        def cursor(value, pk):
+            return base64.urlsafe_b64encode(json.dumps({'v': value, 'i': pk, 'r': False}).encode()).decode()
+
+        for params in [
+            {'cursor': 'not base64'},
+            {'cursor': cursor('not a datetime', 1)},
+            {'cursor': cursor('2024-05-01T10:00:00-05:00', 'not an id')},
+            {'cursor': cursor('2024-05-01T10:00:00-05:00', {'id': 1})},
+            {'cursor': cursor(1, 'not an id'), 'ordering': 'id'},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get('/api/appointments/', {'pagination': 'cursor', **params})
+                self.assertEqual(response.status_code, 404)
+
+    def test_keyset_with_filters(self):
+        date_gt = Appointment.objects.order_by('start')[9].start.isoformat()
+        pages = self.walk({'date_gt': date_gt})
+        self.assertEqual(sum(len(page) for page in pages), 20)
+
+
+class CatalogConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create_user(email='catalog@example.com', first_name='Catalog', last_name='Test')
+        cls.other_company = Company.objects.create_user(email='other@example.com', first_name='Other',
+                                                        last_name='Test')
+        cls.service = Service.objects.create(name='Service', price=100, duration=dt.timedelta(minutes=30),
+                                             time_between_appointments=dt.timedelta(0), company=cls.company)
+        cls.other_service = Service.objects.create(name='Other', price=100, duration=dt.timedelta(minutes=30),
+                                                   time_between_appointments=dt.timedelta(0),
+                                                   company=cls.other_company)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get(self, path: str, params: dict, etag: str = None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(path, params, headers=headers)
+
+    def assertNotModified(self, path: str, params: dict, etag: str):
+        with self.assertNumQueries(0):
+            response = self.get(path, params, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_not_modified_until_the_company_catalog_changes(self):
+        params = {'company': self.company.id}
+        response = self.get('/api/services/', params)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertNotModified('/api/services/', params, etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other_service.name = 'Renamed'
+            self.other_service.save()
+        self.assertNotModified('/api/services/', params, etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TimeFrame.objects.create(service=self.service, weekday=WeekDay.objects.create(name='Lunes'))
+        response = self.get('/api/services/', params, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_the_query(self):
+        first = self.get('/api/services/', {'company': self.company.id})['ETag']
+        second = self.get('/api/services/', {'company': self.other_company.id})['ETag']
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.get('/api/services/', {'company': self.other_company.id}, first).status_code, 200)
+
+    def test_questions_follow_the_company_of_their_service(self):
+        params = {'service': self.service.id}
+        etag = self.get('/api/additional_questions/', params)['ETag']
+        self.assertNotModified('/api/additional_questions/', params, etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AdditionalQuestion.objects.create(text='Question', service=self.service)
+        response = self.get('/api/additional_questions/', params, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+
+
+class AvailabilityTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = company = Company.objects.create_user(email='availability@example.com',
+                                                            first_name='Availability', last_name='Test')
+        cls.location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+        cls.short = Service.objects.create(name='Short', price=100, duration=dt.timedelta(minutes=30),
+                                           time_between_appointments=dt.timedelta(0), company=company)
+        cls.long = Service.objects.create(name='Long', price=100, duration=dt.timedelta(minutes=45),
+                                          time_between_appointments=dt.timedelta(0), company=company)
+        for weekday in range(7):
+            WeekDay.objects.create(id=weekday, name=str(weekday))
+            for service in [cls.short, cls.long]:
+                TimeFrame.objects.create(service=service, weekday_id=weekday, start_time=dt.time(8),
+                                         end_time=dt.time(11))
+        cls.professional = Professional.objects.create(name='Professional', company=company, location=cls.location)
+        cls.professional.services.set([cls.short, cls.long])
+        cls.customer = Customer.objects.create_user(email='customer@example.com', first_name='Customer',
+                                                    last_name='Test')
+        cls.date = timezone.localdate() + dt.timedelta(days=2)
+        # The long service booked 08:45-09:30 leaves the short one 08:00 and 09:30 onwards
+        start = timezone.make_aware(dt.datetime.combine(cls.date, dt.time(8, 45)))
+        Appointment.objects.create(location=cls.location, service=cls.long, professional=cls.professional,
+                                   customer=cls.customer, start=start, end=start + cls.long.duration)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.company)
+
+    def book(self, service, time):
+        start = timezone.make_aware(dt.datetime.combine(self.date, time))
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.create(location=self.location, service=service, professional=self.professional,
+                                       customer=self.customer, start=start, end=start + service.duration)
+
+    def test_slots_overlapping_a_busy_interval_are_taken(self):
+        expected = [dt.time(8), dt.time(9, 30), dt.time(10), dt.time(10, 30)]
+        self.assertEqual(get_cached_available_times(self.professional, self.short, self.date), expected)
+        self.assertEqual(get_available_times_range(self.professional, self.short, self.date, self.date)[self.date],
+                         expected)
+        self.assertEqual([time for time, _ in get_service_available_times(self.short, self.date)], expected)
+        self.assertEqual(get_cached_available_times(self.professional, self.long, self.date),
+                         [dt.time(8), dt.time(9, 30), dt.time(10, 15)])
+
+    def test_range_reads_the_appointments_with_one_query(self):
+        for day in range(1, 6):
+            start = timezone.make_aware(dt.datetime.combine(self.date + dt.timedelta(days=day), dt.time(8)))
+            Appointment.objects.create(location=self.location, service=self.short, professional=self.professional,
+                                       customer=self.customer, start=start, end=start + self.short.duration)
+        last_date = self.date + dt.timedelta(days=6)
+        get_available_times_range(self.professional, self.short, self.date, last_date)
+        # One appointments query whatever the number of appointments, the schedule template being cached
+        with self.assertNumQueries(1):
+            available_times = get_available_times_range(self.professional, self.short, self.date, last_date)
+        self.assertEqual(available_times[self.date + dt.timedelta(days=1)],
+                         [dt.time(8, 30), dt.time(9), dt.time(9, 30), dt.time(10), dt.time(10, 30)])
+
+    def test_day_reads_the_appointments_with_one_query(self):
+        for time in [dt.time(8), dt.time(10), dt.time(10, 30)]:
+            start = timezone.make_aware(dt.datetime.combine(self.date, time))
+            Appointment.objects.create(location=self.location, service=self.short, professional=self.professional,
+                                       customer=self.customer, start=start, end=start + self.short.duration)
+        available_slots(self.professional, self.short, self.date)
+        with self.assertNumQueries(1):
+            slots = available_slots(self.professional, self.short, self.date)
+        self.assertEqual(list(slots), [9 * 3600 + 30 * 60])
+
+    def test_next_available_skips_overlapping_slots(self):
+        start = timezone.make_aware(dt.datetime.combine(self.date, dt.time(8)))
+        Appointment.objects.create(location=self.location, service=self.short, professional=self.professional,
+                                   customer=self.customer, start=start, end=start + self.short.duration)
+        self.assertEqual(find_next_available(self.short, self.date, 1)[:2], (self.date, dt.time(9, 30)))
+
+    def test_booking_leaves_a_racing_miss_behind(self):
+        # A miss that read the key before the booking committed stores its slots under the old version
+        key = availability_cache_key(self.professional.id, self.short.id, self.date)
+        stale = available_slots(self.professional, self.short, self.date)
+        self.book(self.short, dt.time(10))
+        cache.set(key, stale)
+        self.assertEqual(get_cached_available_times(self.professional, self.short, self.date),
+                         [dt.time(8), dt.time(9, 30), dt.time(10, 30)])
+
+    def test_schedule_change_leaves_a_racing_miss_behind(self):
+        timeframe = TimeFrame.objects.filter(service=self.short, weekday_id=self.date.weekday()).get()
+        with self.captureOnCommitCallbacks(execute=True):
+            timeframe.end_time = dt.time(10)
+            timeframe.save()
+            # A request reading before the commit still sees the old timeframe
+            key = availability_cache_key(self.professional.id, self.short.id, self.date)
+            cache.set(key, array('I', [10 * 3600, 10 * 3600 + 30 * 60]))
+        self.assertEqual(get_cached_available_times(self.professional, self.short, self.date),
+                         [dt.time(8), dt.time(9, 30)])
+
+    def test_booking_invalidates_services_the_professional_no_longer_offers(self):
+        self.assertIn(dt.time(10), get_cached_available_times(self.professional, self.short, self.date))
+        self.professional.services.remove(self.short)
+        self.book(self.long, dt.time(10))
+        self.assertEqual(get_cached_available_times(self.professional, self.short, self.date),
+                         [dt.time(8), dt.time(9, 30)])
+
+    def test_appointments_running_into_the_day_are_busy(self):
+        start = timezone.make_aware(dt.datetime.combine(self.date - dt.timedelta(days=1), dt.time(12)))
+        Appointment.objects.create(location=self.location, service=self.short, professional=self.professional,
+                                   customer=self.customer, start=start, end=start + dt.timedelta(hours=22))
+        self.assertEqual(get_cached_available_times(self.professional, self.short, self.date),
+                         [dt.time(10), dt.time(10, 30)])
+
+    def test_appointments_cannot_outlast_the_overlap_bound(self):
+        start = timezone.make_aware(dt.datetime.combine(self.date, dt.time(8)))
+        data = {'location': self.location.id, 'service': self.short.id, 'professional': self.professional.id,
+                'start': start}
+        longest = start + MAX_APPOINTMENT_DURATION
+        self.assertTrue(AppointmentSerializer(data={**data, 'end': longest}).is_valid())
+        self.assertFalse(AppointmentSerializer(data={**data, 'end': longest + dt.timedelta(minutes=1)}).is_valid())
+        self.assertFalse(AppointmentSerializer(data={**data, 'end': start}).is_valid())
+
+    def test_service_available_times_validates_location(self):
+        path = f'/api/get_service_available_times/{self.short.id}/{self.date.isoformat()}'
+        self.assertEqual(self.client.get(path, {'location': 'abc'}).status_code, 400)
+        response = self.client.get(path, {'location': self.location.id})
+        self.assertEqual([slot['id'] for slot in response.data],
+                         [dt.time(8), dt.time(9, 30), dt.time(10), dt.time(10, 30)])
+
+    def test_next_available_validates_ids(self):
+        path = f'/api/next_available/{self.short.id}/'
+        response = self.client.get(path, {'professional': 'abc', 'location': '1x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'professional', 'location'})
+        response = self.client.get(path, {'professional': self.professional.id, 'location': self.location.id,
+                                          'from': self.date.isoformat()})
+        self.assertEqual((response.data['date'], response.data['time']), (self.date, dt.time(8)))
+
+
+class BookingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create_user(email='booking@example.com', first_name='Booking', last_name='Test')
+        cls.location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+        cls.service = Service.objects.create(name='Service', price=100, duration=dt.timedelta(minutes=30),
+                                             time_between_appointments=dt.timedelta(0), company=company)
+        cls.long = Service.objects.create(name='Long', price=100, duration=dt.timedelta(minutes=45),
+                                          time_between_appointments=dt.timedelta(0), company=company)
+        for weekday in range(7):
+            WeekDay.objects.create(id=weekday, name=str(weekday))
+            for service in [cls.service, cls.long]:
+                TimeFrame.objects.create(service=service, weekday_id=weekday, start_time=dt.time(8),
+                                         end_time=dt.time(11))
+        cls.professional = Professional.objects.create(name='Professional', company=company, location=cls.location)
+        cls.professional.services.add(cls.service, cls.long)
+        cls.company = company
+        cls.date = timezone.localdate() + dt.timedelta(days=2)
+
+    def setUp(self):
+        cache.clear()
+
+    def booking_data(self, **data) -> dict:
+        return {'date': self.date.isoformat(), 'time': '08:00:00', 'service': self.service.id,
+                'location': self.location.id, 'professional': self.professional.id, 'citizen_id': '1001',
+                'email': 'customer@example.com', 'name': 'Customer', 'first_name': 'Customer', 'last_name': 'Test',
+                'phone': '3000000000', **data}
+
+    def test_series_refreshes_stats_once_and_enqueues_per_occurrence(self):
+        # The on-commit availability rebuild is part of the request
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                data = self.booking_data(rule=f'FREQ=WEEKLY;COUNT={MAX_SERIES_OCCURRENCES}')
+                response = APIClient().post('/api/new_appointment_series/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        # Independent of the number of occurrences and of services
+        self.assertLess(len(queries), 40)
+        appointments = list(Appointment.objects.order_by('start'))
+        self.assertEqual(len(appointments), MAX_SERIES_OCCURRENCES)
+        rollup = set(DailyCompanyStats.objects.values_list('date', 'appointments', 'revenue'))
+        self.assertEqual(rollup, {(timezone.localdate(appointment.start), 1, 100) for appointment in appointments})
+
+        tasks = list(OutboxMessage.objects.values_list('task', 'args', 'eta'))
+        self.assertEqual(len(tasks), 1 + 2 * len(appointments))
+        reminders = {args[0]: eta for task, args, eta in tasks if task.endswith('send_reminder_email')}
+        self.assertEqual(reminders, {appointment.id: appointment.start - dt.timedelta(days=1)
+                                     for appointment in appointments})
+        calendar_events = [args[0] for task, args, _ in tasks if task.endswith('new_appointment_add_to_calendar')]
+        self.assertEqual(sorted(calendar_events), [appointment.id for appointment in appointments])
+        for service in [self.service, self.long]:
+            self.assertNotIn(dt.time(8), get_cached_available_times(self.professional, service, self.date))
+
+    def book(self, data=None, **headers):
+        return APIClient().post('/api/new_appointment/', data or self.booking_data(), format='json', headers=headers)
+
+    def test_overlapping_booking_is_a_conflict(self):
+        # 08:30 is a slot of the service but the 45 minute booking runs until 08:45
+        self.assertEqual(self.book(self.booking_data(service=self.long.id)).status_code, 201)
+        response = self.book(self.booking_data(time='08:30:00'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    @mock.patch('appointments.booking.is_overlapping', return_value=False)
+    def test_unique_start_violation_is_a_conflict(self, is_overlapping):
+        # Two bookings that both passed the overlap check: the unique (professional, start) index rejects one
+        self.assertEqual(self.book().status_code, 201)
+        outbox = OutboxMessage.objects.count()
+        self.assertEqual(self.book().status_code, 409)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), outbox)
+
+    def test_idempotent_replay_returns_the_stored_response(self):
+        first = self.book(**{'Idempotency-Key': 'retry'})
+        self.assertEqual(first.status_code, 201)
+        outbox = OutboxMessage.objects.count()
+        with self.assertNumQueries(1):
+            replay = self.book(**{'Idempotency-Key': 'retry'})
+        self.assertEqual((replay.status_code, replay.json()), (201, first.json()))
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), outbox)
+
+    def test_concurrent_retry_returns_the_stored_response(self):
+        # The retry looked the key up before the first request committed, then lost the slot to it
+        first = self.book(**{'Idempotency-Key': 'retry'})
+        outbox = OutboxMessage.objects.count()
+        with mock.patch('appointments.views.get_stored_response', side_effect=self.late_lookup()):
+            retry = self.book(**{'Idempotency-Key': 'retry'})
+        self.assertEqual((retry.status_code, retry.json()), (201, first.json()))
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), outbox)
+
+    def late_lookup(self):
+        # get_stored_response that misses on the first call, as if the first request had not committed yet
+        lookups = []
+
+        def lookup(request_key):
+            lookups.append(request_key)
+            return get_stored_response(request_key) if len(lookups) > 1 else None
+        return lookup
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.assertEqual(self.book(**{'Idempotency-Key': 'retry'}).status_code, 201)
+        response = self.book(self.booking_data(time='09:00:00'), **{'Idempotency-Key': 'retry'})
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('idempotency_key', response.json())
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_keys_are_scoped_by_endpoint_and_user(self):
+        self.assertEqual(self.book(**{'Idempotency-Key': 'retry'}).status_code, 201)
+
+        # Another user sending the same key and body books again, and loses the slot
+        client = APIClient()
+        client.force_authenticate(self.company)
+        response = client.post('/api/new_appointment/', self.booking_data(), format='json',
+                               headers={'Idempotency-Key': 'retry'})
+        self.assertEqual(response.status_code, 409)
+
+        # The same key on the series endpoint is a new request
+        data = self.booking_data(time='09:00:00', rule='FREQ=WEEKLY;COUNT=2')
+        response = APIClient().post('/api/new_appointment_series/', data, format='json',
+                                    headers={'Idempotency-Key': 'retry'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Appointment.objects.count(), 3)
+
+    def test_concurrent_series_retry_returns_the_stored_response(self):
+        data = self.booking_data(rule='FREQ=WEEKLY;COUNT=2')
+        first = APIClient().post('/api/new_appointment_series/', data, format='json',
+                                 headers={'Idempotency-Key': 'retry'})
+        self.assertEqual(first.status_code, 201)
+        outbox = OutboxMessage.objects.count()
+
+        # The retry sees the first series as a conflict once it gets the professional's lock
+        with mock.patch('appointments.views.get_stored_response', side_effect=self.late_lookup()):
+            retry = APIClient().post('/api/new_appointment_series/', data, format='json',
+                                     headers={'Idempotency-Key': 'retry'})
+        self.assertEqual((retry.status_code, retry.json()), (201, first.json()))
+
+        # Or it checked the occurrences first and fails on the unique start index
+        def all_free(professional_id, template, occurrences):
+            return [(timezone.make_aware(occurrence), None) for occurrence in occurrences]
+        with mock.patch('appointments.views.get_stored_response', side_effect=self.late_lookup()), \
+                mock.patch('appointments.views.check_occurrences', side_effect=all_free):
+            retry = APIClient().post('/api/new_appointment_series/', data, format='json',
+                                     headers={'Idempotency-Key': 'retry'})
+        self.assertEqual((retry.status_code, retry.json()), (201, first.json()))
+        self.assertEqual(Appointment.objects.count(), 2)
+        self.assertEqual(OutboxMessage.objects.count(), outbox)
+
+
+class StatsRollupTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = company = Company.objects.create_user(email='stats@example.com', first_name='Stats',
+                                                            last_name='Test')
+        cls.location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+        cls.services = [
+            Service.objects.create(name=f'Service {price}', price=price, duration=dt.timedelta(minutes=30),
+                                   time_between_appointments=dt.timedelta(0), company=company)
+            for price in [100, 250]
+        ]
+        cls.professionals = [
+            Professional.objects.create(name=f'Professional {number}', company=company, location=cls.location)
+            for number in range(2)
+        ]
+        cls.customers = [
+            Customer.objects.create_user(email=f'stats{number}@example.com', first_name=f'Customer {number}',
+                                         last_name='Test')
+            for number in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.company)
+
+    def create(self, service, professional, customer, day: int, time: dt.time) -> Appointment:
+        start = timezone.make_aware(dt.datetime.combine(timezone.localdate() + dt.timedelta(days=day), time))
+        return Appointment.objects.create(location=self.location, service=service, professional=professional,
+                                          customer=customer, start=start, end=start + service.duration)
+
+    def rollup(self) -> tuple:
+        return (
+            set(DailyCompanyStats.objects.values_list('company_id', 'date', 'service_id', 'professional_id',
+                                                      'appointments', 'completed', 'revenue', 'customers')),
+            set(CompanyCustomer.objects.values_list('company_id', 'customer_id', 'first_appointment')),
+        )
+
+    def test_rollup_matches_a_rebuild(self):
+        short, long = self.services
+        first, second = self.professionals
+        appointments = [
+            self.create(short, first, self.customers[0], -3, dt.time(9)),
+            self.create(short, first, self.customers[1], -3, dt.time(10)),
+            self.create(long, second, self.customers[1], -1, dt.time(11)),
+            # Evening in Bogota is the next day in UTC, and must count on the local date
+            self.create(long, first, self.customers[2], 0, dt.time(20)),
+            self.create(short, second, self.customers[0], 2, dt.time(8)),
+        ]
+        appointments[0].delete()
+        appointments[1].is_complete = True
+        appointments[1].save()
+        # Move to another day, professional and service, which empties the bucket it leaves
+        moved = Appointment.objects.get(pk=appointments[2].pk)
+        moved.start += dt.timedelta(days=5)
+        moved.end = moved.start + short.duration
+        moved.professional = first
+        moved.service = short
+        moved.save()
+
+        incremental = self.rollup()
+        self.assertEqual(len(incremental[0]), 4)
+        rebuild_company_stats(self.company.id)
+        self.assertEqual(self.rollup(), incremental)
+
+    def test_etag_is_revalidated_until_an_appointment_changes(self):
+        path = f'/api/stats/{self.company.id}/'
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create(self.services[0], self.professionals[0], self.customers[0], 1, dt.time(9))
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['total_appointments'], 1)
+
+
+class ExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create_user(email='export@example.com', first_name='Export', last_name='Test')
+        other_company = Company.objects.create_user(email='other@example.com', first_name='Other', last_name='Test')
+        cls.appointments = []
+        for company, customer_names in [(cls.company, ['Alicia', 'Bruno', 'Carla']), (other_company, ['Alicia'])]:
+            location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+            service = Service.objects.create(name='Service', price=100, duration=dt.timedelta(minutes=30),
+                                             time_between_appointments=dt.timedelta(0), company=company)
+            professional = Professional.objects.create(name='Professional', company=company, location=location)
+            for day, name in enumerate(customer_names, start=1):
+                customer = Customer.objects.create_user(email=f'{name}{company.id}@example.com', first_name=name,
+                                                        last_name='Test')
+                start = timezone.make_aware(dt.datetime.combine(timezone.localdate() + dt.timedelta(days=day),
+                                                                dt.time(9)))
+                cls.appointments.append(Appointment.objects.create(
+                    location=location, service=service, professional=professional, customer=customer,
+                    start=start, end=start + service.duration))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.company)
+
+    def export(self, **params):
+        response = self.client.get('/api/appointments/export/', {'company': self.company.id, **params})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        lines = self.export().splitlines()
+        self.assertEqual(lines[0], ','.join(EXPORT_COLUMNS))
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]],
+                         [appointment.id for appointment in self.appointments[:3]])
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export(export_format='ndjson').splitlines()]
+        self.assertEqual([row['id'] for row in rows], [appointment.id for appointment in self.appointments[:3]])
+        self.assertEqual(rows[0]['customer'], 'Alicia Test')
+        self.assertEqual(rows[0]['start'], timezone.localtime(self.appointments[0].start).isoformat())
+
+    def test_filters_apply_to_the_streamed_rows(self):
+        second = self.appointments[1]
+        rows = [json.loads(line) for line in self.export(export_format='ndjson', search='bruno').splitlines()]
+        self.assertEqual([row['id'] for row in rows], [second.id])
+        rows = [json.loads(line) for line in
+                self.export(export_format='ndjson', date_gt=second.start.isoformat()).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.appointments[2].id])
+
+    def test_unknown_format(self):
+        response = self.client.get('/api/appointments/export/', {'export_format': 'xlsx'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('export_format', response.data)
+
+
+class FakeTasks:
+    # Stand-in for current_app.tasks recording apply_async calls, failing once for the task names in fail
+    def __init__(self, fail=()):
+        self.published = []
+        self.fail = set(fail)
+
+    def __getitem__(self, name):
+        return mock.Mock(apply_async=lambda args, eta: self.publish(name, args, eta))
+
+    def publish(self, name, args, eta):
+        if name in self.fail:
+            self.fail.discard(name)
+            raise ConnectionError('broker unavailable')
+        self.published.append((name, args, eta))
+
+
+class OutboxRelayTest(TestCase):
+    def setUp(self):
+        self.eta = timezone.now() + dt.timedelta(hours=1)
+        self.messages = [
+            OutboxMessage.objects.create(task=f'task.{number}', args=[number], eta=self.eta if number == 2 else None)
+            for number in range(5)
+        ]
+
+    def relay(self, tasks, **kwargs):
+        with mock.patch('appointments.outbox.current_app', tasks=tasks):
+            return relay_outbox(**kwargs)
+
+    def test_relays_in_id_order_across_batches(self):
+        tasks = FakeTasks()
+        self.assertEqual(self.relay(tasks, batch_size=2), 5)
+        self.assertEqual(tasks.published, [(f'task.{number}', [number], self.eta if number == 2 else None)
+                                           for number in range(5)])
+        self.assertFalse(OutboxMessage.objects.filter(sent_at__isnull=True).exists())
+        # Sent messages are not published again
+        self.assertEqual(self.relay(tasks), 0)
+        self.assertEqual(len(tasks.published), 5)
+
+    def test_failed_publish_leaves_the_message_and_the_later_ones_pending(self):
+        tasks = FakeTasks(fail=['task.3'])
+        with self.assertRaises(ConnectionError):
+            self.relay(tasks, batch_size=2)
+        pending = OutboxMessage.objects.filter(sent_at__isnull=True).order_by('id').values_list('task', flat=True)
+        # The batch holding the failure is retried as a whole, so delivery is at least once
+        self.assertEqual(list(pending), ['task.2', 'task.3', 'task.4'])
+
+        self.assertEqual(self.relay(tasks, batch_size=2), 3)
+        self.assertEqual([name for name, _, _ in tasks.published],
+                         ['task.0', 'task.1', 'task.2', 'task.2', 'task.3', 'task.4'])
+        self.assertFalse(OutboxMessage.objects.filter(sent_at__isnull=True).exists())
+
+    def test_purge_deletes_only_old_sent_messages(self):
+        now = timezone.now()
+        old, recent, pending = self.messages[:3]
+        OutboxMessage.objects.filter(pk=old.pk).update(sent_at=now - OUTBOX_RETENTION - dt.timedelta(minutes=1))
+        OutboxMessage.objects.filter(pk=recent.pk).update(sent_at=now - OUTBOX_RETENTION + dt.timedelta(minutes=1))
+        OutboxMessage.objects.filter(pk=pending.pk).update(created_at=now - OUTBOX_RETENTION * 2)
+        self.assertEqual(purge_outbox(), 1)
+        self.assertFalse(OutboxMessage.objects.filter(pk=old.pk).exists())
+        self.assertEqual(OutboxMessage.objects.count(), 4)
+
+
+class StatsViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = company = Company.objects.create_user(email='statsview@example.com', first_name='Stats',
+                                                            last_name='View')
+        location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+        service = Service.objects.create(name='Service', price=100, duration=dt.timedelta(minutes=30),
+                                         time_between_appointments=dt.timedelta(0), company=company)
+        professional = Professional.objects.create(name='Professional', company=company, location=location)
+        customer = Customer.objects.create_user(email='statsview.customer@example.com', first_name='Customer',
+                                                last_name='Test')
+        # Monday, Wednesday, the next Tuesday, and a Wednesday in April whose week starts in March
+        cls.dates = [dt.date(2026, 3, 2), dt.date(2026, 3, 4), dt.date(2026, 3, 10), dt.date(2026, 4, 1)]
+        for date in cls.dates:
+            start = timezone.make_aware(dt.datetime.combine(date, dt.time(10)))
+            Appointment.objects.create(location=location, service=service, professional=professional,
+                                       customer=customer, start=start, end=start + service.duration)
+        cls.path = f'/api/stats/{company.id}/'
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.company)
+
+    def periods(self, **params) -> list:
+        response = self.client.get(self.path, params)
+        self.assertEqual(response.status_code, 200)
+        return [row[0] for row in response.data['appointments_per_service_per_date'][1:]]
+
+    def test_granularities(self):
+        self.assertEqual(self.periods(), self.dates)
+        self.assertEqual(self.periods(granularity='week'),
+                         [dt.date(2026, 3, 2), dt.date(2026, 3, 9), dt.date(2026, 3, 30)])
+        self.assertEqual(self.periods(granularity='month'), [dt.date(2026, 3, 1), dt.date(2026, 4, 1)])
+
+    def test_window(self):
+        self.assertEqual(self.client.get(self.path).data['total_appointments'], 4)
+        response = self.client.get(self.path, {'from': '2026-03-03', 'to': '2026-03-10'})
+        self.assertEqual(response.data['total_appointments'], 2)
+        self.assertEqual(self.periods(**{'from': '2026-03-03', 'to': '2026-03-10'}), self.dates[1:3])
+
+    def test_invalid_params(self):
+        for params, field in [
+            ({'from': '2026-13-01'}, 'from'),
+            ({'to': 'yesterday'}, 'to'),
+            ({'from': '2026-03-10', 'to': '2026-03-03'}, 'to'),
+            ({'granularity': 'year'}, 'granularity'),
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(self.path, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(field, response.data)
+
+    def test_etag_depends_on_the_params(self):
+        etags = [
+            self.client.get(self.path, params)['ETag']
+            for params in [{}, {'granularity': 'week'}, {'from': '2026-03-03'}, {'to': '2026-03-10'}]
+        ]
+        self.assertEqual(len(set(etags)), len(etags))
+        self.assertEqual(self.client.get(self.path, {'granularity': 'week'})['ETag'], etags[1])
+
+
+class ORJSONTest(TestCase):
+    def assertSameRendering(self, data, accepted_media_type=None):
+        self.assertEqual(ORJSONRenderer().render(data, accepted_media_type),
+                         JSONRenderer().render(data, accepted_media_type))
+
+    def test_renders_like_drf(self):
+        self.assertSameRendering({
+            'datetime': dt.datetime(2026, 3, 2, 10, 30, 15, 123456, tzinfo=dt.timezone.utc),
+            'local': timezone.localtime(timezone.make_aware(dt.datetime(2026, 3, 2, 10, 30))),
+            'date': dt.date(2026, 3, 2),
+            'time': dt.time(10, 30, 15, 5),
+            'timedelta': dt.timedelta(hours=1, minutes=30),
+            'decimal': Decimal('12.50'),
+            'uuid': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'lazy': gettext_lazy('Date'),
+            'keys': {1: 'int', 1.5: 'float', True: 'bool', None: 'none'},
+            'text': 'Cita con Peña \u2028\u2029',
+            'float': 0.1,
+        })
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_indent(self):
+        data = {'a': [1, {'b': 2}]}
+        self.assertSameRendering(data, 'application/json; indent=2')
+        # orjson only indents by 2
+        self.assertEqual(ORJSONRenderer().render(data, 'application/json; indent=4'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_ascii_and_spaced_output_are_left_to_drf(self):
+        for attributes in [{'ensure_ascii': True}, {'compact': False}]:
+            with self.subTest(**attributes):
+                renderer = type('Renderer', (ORJSONRenderer,), attributes)()
+                legacy = type('Renderer', (JSONRenderer,), attributes)()
+                data = {'text': 'Peña', 'list': [1, 2]}
+                self.assertEqual(renderer.render(data), legacy.render(data))
+
+    def test_known_differences(self):
+        self.assertEqual(ORJSONRenderer().render([1e16, 1.5e-7]), b'[1e16,1.5e-7]')
+        self.assertEqual(JSONRenderer().render([1e16, 1.5e-7]), b'[1e+16,1.5e-07]')
+        self.assertEqual(ORJSONRenderer().render({dt.date(2026, 3, 2): 1}), b'{"2026-03-02":1}')
+        with self.assertRaises(TypeError):
+            JSONRenderer().render({dt.date(2026, 3, 2): 1})
+
+    def test_parses_like_drf(self):
+        body = '{"name": "Peña", "values": [1, 2.5, null, true]}'.encode()
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body)))
+        latin1 = '{"name": "Peña"}'.encode('latin-1')
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(latin1), parser_context={'encoding': 'latin-1'}),
+                         {'name': 'Peña'})
+
+    def test_parse_errors(self):
+        for body in [b'{"a": ', b'{"a": NaN}', b'[Infinity]', '{"a": "Peña"}'.encode('latin-1'), b'']:
+            with self.subTest(body=body):
+                with self.assertRaises(ParseError):
+                    ORJSONParser().parse(io.BytesIO(body))
+
+
+class NotificationPayloadTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create_user(email='payload@example.com', first_name='Payload', last_name='Test',
+                                              phone='3000000000')
+        CompanyProfile.objects.create(company=company, name='Clinic', address='Calle 1', phone='0', slug='payload',
+                                      calendar_id='calendar', reviews_link='https://example.com/reviews')
+        location = Location.objects.create(name='Main', address='Main', phone='0', company=company)
+        service = Service.objects.create(name='Cleaning', price=100, duration=dt.timedelta(minutes=30),
+                                         time_between_appointments=dt.timedelta(0), company=company)
+        professional = Professional.objects.create(name='Professional', company=company, location=location)
+        customer = Customer.objects.create_user(email='payload.customer@example.com', first_name='Ana',
+                                                last_name='Test', phone='3100000000')
+        start = timezone.make_aware(dt.datetime(2026, 3, 2, 10, 30))
+        cls.appointment = Appointment.objects.create(location=location, service=service, professional=professional,
+                                                     customer=customer, start=start, end=start + service.duration)
+
+    def test_payload_is_built_from_one_query(self):
+        with self.assertNumQueries(1):
+            payload = build_appointment_payload(self.appointment.id)
+        self.assertEqual({key: payload[key] for key in [
+            'customer_full_name', 'company_name', 'company_phone', 'service_name', 'professional_name', 'start',
+            'end', 'calendar_id', 'reviews_link', 'location_is_virtual',
+        ]}, {
+            'customer_full_name': 'Ana Test', 'company_name': 'Clinic', 'company_phone': '3000000000',
+            'service_name': 'Cleaning', 'professional_name': 'Professional', 'start': '2026-03-02T10:30:00',
+            'end': '2026-03-02T11:00:00', 'calendar_id': 'calendar', 'reviews_link': 'https://example.com/reviews',
+            'location_is_virtual': False,
+        })
+
+    def test_cancelled_appointments_and_old_messages(self):
+        self.appointment.delete()
+        self.assertIsNone(resolve_payload(self.appointment.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_payload({'customer_email': 'old@example.com'}, 0),
+                             {'customer_email': 'old@example.com'})
@@ -12,8 +12,13 @@ router.register(r'professionals', ProfessionalViewSet)
 router.register(r'additional_questions', AdditionalQuestionViewSet)
 urlpatterns = [
     path('new_appointment/', NewAppointmentView.as_view(), name='new_appointment'),
+    path('new_appointment_series/', NewAppointmentSeriesView.as_view(), name='new_appointment_series'),
     path('process_payment/', ProcessPaymentView.as_view(), name='process_payment'),
     path('plans_info/', GetPlansInfo.as_view(), name='process_payment'),
     path('stats/<int:company_id>/', StatsView.as_view(), name='process_payment'),
+    path('cache_stats/', CacheStatsView.as_view(), name='cache-stats'),
     path("get_available_times/<int:professional_id>/<int:service_id>/<str:date>", AvailableTimesView.as_view(), name='available-times'),
+    path("get_available_times/<int:professional_id>/<int:service_id>", AvailableTimesRangeView.as_view(), name='available-times-range'),
+    path('next_available/<int:service_id>/', NextAvailableView.as_view(), name='next-available'),
+    path("get_service_available_times/<int:service_id>/<str:date>", ServiceAvailableTimesView.as_view(), name='service-available-times'),
 ]
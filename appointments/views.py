@@ -1,45 +1,95 @@
+import hashlib
 import json
 
-from django.db import transaction
-from django.db.models import Count, Sum
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
 from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets, permissions, status, filters
-from rest_framework.pagination import PageNumberPagination
+from rest_framework import viewsets, permissions, serializers, status, filters
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from accounts.serializers import CustomerSerializer
+from .availability import availability_counter, find_next_available, get_cached_available_times, \
+    get_available_times_range, get_service_available_times
+from .booking import SlotUnavailable, create_appointment, lock_professional
+from .catalog import CatalogConditionalGetMixin, catalog_counter, service_company_id
+from .export import EXPORT_FORMATS, export_rows
 from .filters import AppointmentFilterBackend
+from .idempotency import get_idempotency_key, get_stored_response, store_response
+from .notifications import PAYLOAD_VERSION
+from .outbox import enqueue_many
+from .pagination import AppointmentPagination
+from .schedule import get_schedule_template
+from .search import AppointmentSearchFilter
+from .series import CONFLICT_MESSAGES, MAX_SERIES_OCCURRENCES, SERIES_REMINDER_LEAD_TIME, InvalidRule, \
+    check_occurrences, expand_rule
+from .signals import refresh_created_appointments
+from .stats import GRANULARITIES, get_cached_company_stats, stats_cache_key, stats_counter
 from .serializers import *
 import mercadopago
 from datetime import datetime
 from .tasks import *
-from .templatetags.custom_tags import duration
-
-
-class CustomPageNumberPagination(PageNumberPagination):
-    page_size = 10
-    page_size_query_param = 'page_size'
-    max_page_size = 100
-
-    def paginate_queryset(self, queryset, request, view=None):
-        if request.query_params.get('get_all', False) == 'true':
-            return None
-        return super().paginate_queryset(queryset, request, view=view)
 
 
 class AppointmentViewSet(viewsets.ModelViewSet):
     queryset = Appointment.objects.all().order_by('id')
     serializer_class = AppointmentSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = CustomPageNumberPagination
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter, AppointmentFilterBackend]
-    search_fields = ['customer__first_name', 'location__name', 'service__name', 'professional__name']
+    pagination_class = AppointmentPagination
+    filter_backends = [AppointmentSearchFilter, filters.OrderingFilter, AppointmentFilterBackend]
     ordering_fields = ['id', 'location__name', 'service__name', 'professional__name', 'date']
 
+    # Compact representation for the company calendar, selected with ?view=calendar
+    calendar_fields = ['id', 'start', 'end', 'title', 'professional']
 
-class ServiceViewSet(viewsets.ModelViewSet):
+    def get_fields(self):
+        # Fields chosen with ?fields=a,b or ?view=calendar when listing or retrieving, else every field
+        if self.action not in ('list', 'retrieve'):
+            return None
+        if self.request.query_params.get('view') == 'calendar':
+            return self.calendar_fields
+        if not self.request.query_params.get('fields'):
+            return None
+        fields = [name.strip() for name in self.request.query_params['fields'].split(',') if name.strip()]
+        unknown = set(fields) - set(self.serializer_class().fields)
+        if unknown:
+            raise serializers.ValidationError({'fields': [f'Campos desconocidos: {", ".join(sorted(unknown))}.']})
+        return fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            # Only the columns and joins the selected fields read, so a page costs one query whatever its size
+            columns = self.get_serializer().get_columns()
+            relations = {column.split('__')[0] for column in columns if '__' in column}
+            if relations:
+                # select_related() without arguments would follow every relation
+                queryset = queryset.select_related(*relations)
+            return queryset.only(*columns)
+        return queryset.select_related('service', 'location', 'professional', 'customer')
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        # export_format rather than format, which DRF reserves for content negotiation
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'export_format': [f'Seleccione una opción válida: {", ".join(EXPORT_FORMATS)}.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        lines, content_type, extension = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(lines(export_rows(self.filter_queryset(self.get_queryset()))),
+                                         content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="appointments.{extension}"'
+        return response
+
+
+class ServiceViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -107,7 +157,7 @@ class ServiceViewSet(viewsets.ModelViewSet):
         return self.create_or_update(request, update=True)
 
 
-class LocationViewSet(viewsets.ModelViewSet):
+class LocationViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -135,7 +185,7 @@ class LocationViewSet(viewsets.ModelViewSet):
         return super().list(request, *args, **kwargs)
 
 
-class ProfessionalViewSet(viewsets.ModelViewSet):
+class ProfessionalViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Professional.objects.all()
     serializer_class = ProfessionalSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -154,104 +204,126 @@ class ProfessionalViewSet(viewsets.ModelViewSet):
         return Response(professional_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class AdditionalQuestionViewSet(viewsets.ModelViewSet):
+class AdditionalQuestionViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
     queryset = AdditionalQuestion.objects.all()
     serializer_class = AdditionalQuestionSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     filterset_fields = ['service']
+    catalog_company_param = 'service'
+
+    def get_catalog_company_id(self):
+        service_id = super().get_catalog_company_id()
+        return service_company_id(service_id) if service_id else None
+
+
+def parse_booking_start(data) -> tuple:
+    # Start datetime of a public booking request and the errors of its required fields
+    # Make sure all the required fields are present
+    required_fields = ['date', 'time', 'service','location','professional','citizen_id', 'email','name', 'last_name', 'email','phone']
+    errors = {}
+    for field in required_fields:
+        if field not in data or not data[field]:
+            errors[field] = ['Este campo es requerido.']
+
+    try:
+        start_date = datetime.strptime(data['date'], '%Y-%m-%d')
+    except ValueError:
+        errors['date'] = ['La fecha seleccionada es inválida.']
+    except KeyError:
+        pass
+
+    try:
+        start_time = datetime.strptime(data['time'], '%H:%M:%S')
+    except ValueError:
+        errors['time'] = ['La hora seleccionada es inválida.']
+    except KeyError:
+        pass
+
+    if errors:
+        return None, errors
+    return datetime.combine(start_date, start_time.time()), errors
+
+
+def get_customer_serializer(data):
+    # Serializer updating the customer with the same citizen id or email, or creating a new one.
+    # None when the citizen id is not numeric.
+    try:
+        customer = Customer.objects.get(citizen_id=data['citizen_id'])
+        return CustomerSerializer(customer, data=data)
+    except Customer.DoesNotExist:
+        try:
+            customer = Customer.objects.get(email=data['email'])
+            return CustomerSerializer(customer, data=data)
+        except Customer.DoesNotExist:
+            return CustomerSerializer(data=data)
+    except ValueError:
+        return None
 
 
 class NewAppointmentView(APIView):
     permission_classes = [permissions.AllowAny]
 
     def post(self, request):
-        # Make sure all the required fields are present
-        print(request.data)
-        required_fields = ['date', 'time', 'service','location','professional','citizen_id', 'email','name', 'last_name', 'email','phone']
-        errors = {}
-        for field in required_fields:
-            if field not in request.data or not request.data[field]:
-                errors[field] = ['Este campo es requerido.']
-
-        try:
-            start_date = datetime.strptime(request.data['date'], '%Y-%m-%d')
-        except ValueError:
-            errors['date'] = ['La fecha seleccionada es inválida.']
-        except KeyError:
-            pass
-
-        try:
-            start_time = datetime.strptime(request.data['time'], '%H:%M:%S')
-        except ValueError:
-            errors['time'] = ['La hora seleccionada es inválida.']
-        except KeyError:
-            pass
-
+        idempotency_key = get_idempotency_key(request, 'new_appointment')
+        if idempotency_key and len(idempotency_key.key) > 255:
+            return Response({'idempotency_key': ['La llave de idempotencia no puede superar 255 caracteres.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Retries of an already completed booking get the original response back
+        stored_response = get_stored_response(idempotency_key)
+        if stored_response is not None:
+            return stored_response
+
+        start, errors = parse_booking_start(request.data)
         if errors:
             return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-
-        start = datetime.combine(start_date, start_time.time())
-        end = start + Service.objects.get(pk=request.data['service']).duration
+        try:
+            schedule = get_schedule_template(int(request.data['service']))
+        except (Service.DoesNotExist, ValueError):
+            return Response({'service': ['El servicio seleccionado es inválido.']}, status=status.HTTP_400_BAD_REQUEST)
+        if not schedule.is_slot(start):
+            return Response({'time': ['La hora seleccionada no está disponible.']}, status=status.HTTP_400_BAD_REQUEST)
+        end = start + schedule.duration
         appointment_data = request.data.copy()
         appointment_data['start'] = start
         appointment_data['end'] = end
-        appointment_serializer = AppointmentSerializer(data=appointment_data)
-        try:
-            customer = Customer.objects.get(citizen_id=request.data['citizen_id'])
-            customer_serializer = CustomerSerializer(customer, data=request.data)
-        except Customer.DoesNotExist:
-            try:
-                customer = Customer.objects.get(email=request.data['email'])
-                customer_serializer = CustomerSerializer(customer, data=request.data)
-            except Customer.DoesNotExist:
-                customer_serializer = CustomerSerializer(data=request.data)
-        except ValueError:
-            errors['citizen_id'] = ['El número de cédula debe ser numérico.']
-            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        appointment_serializer = BookingAppointmentSerializer(data=appointment_data)
+        customer_serializer = get_customer_serializer(request.data)
+        if customer_serializer is None:
+            return Response({'citizen_id': ['El número de cédula debe ser numérico.']},
+                            status=status.HTTP_400_BAD_REQUEST)
 
         valid_appointment = appointment_serializer.is_valid()
         valid_customer = customer_serializer.is_valid()
         if valid_appointment and valid_customer:
-            customer = customer_serializer.save()
-            appointment = appointment_serializer.save(customer=customer)
-            data = {
-                'customer': customer_serializer.data,
-                'appointment': appointment_serializer.data,
-            }
-            appointment_data = {
-                'customer_email': customer.email,
-                "customer_full_name": customer.full_name,
-                "start": start.isoformat(),
-                "end": end.isoformat(),
-                "company_email": appointment.service.company.email,
-                "company_phone": appointment.service.company.phone,
-                "company_address": appointment.service.company.companyprofile.address,
-                "company_name": appointment.service.company.companyprofile.name,
-                "customer_phone": appointment.customer.phone,
-                "service_duration": duration(appointment.service.duration),
-                "service_description": appointment.service.description,
-                "service_name": appointment.service.name,
-                "date": appointment.start.date().isoformat(),
-                "time": appointment.start.time().isoformat(),
-                "professional_name": appointment.professional.name,
-                "calendar_id": appointment.service.company.companyprofile.calendar_id,
-                "start_isoformat": start.isoformat(),
-                "end_isoformat": end.isoformat(),
-                "google_credentials": appointment.service.company.companyprofile.google_credentials,
-                "location_is_virtual": appointment.location.is_virtual,
-                "reviews_link": appointment.service.company.companyprofile.reviews_link
-            }
-
-            transaction.on_commit(lambda: new_appointment_notify_customer.delay(appointment_data))
-            transaction.on_commit(lambda: new_appointment_notify_company.delay(appointment_data))
-            transaction.on_commit(lambda: new_appointment_add_to_calendar.delay(appointment_data))
-
-            in_1_minute = timezone.now() + timezone.timedelta(minutes=1)
-            in_2_minutes = timezone.now() + timezone.timedelta(minutes=2)
-            send_reminder_email.apply_async((appointment_data,), eta=in_1_minute)
-            send_review_email.apply_async((appointment_data,), eta=in_2_minutes)
-
+            try:
+                with transaction.atomic():
+                    customer = customer_serializer.save()
+                    appointment = create_appointment(appointment_serializer, customer=customer)
+                    data = {
+                        'customer': customer_serializer.data,
+                        'appointment': appointment_serializer.data,
+                    }
+                    in_1_minute = timezone.now() + timezone.timedelta(minutes=1)
+                    in_2_minutes = timezone.now() + timezone.timedelta(minutes=2)
+                    enqueue_many([
+                        (new_appointment_notify_customer, (appointment.id, PAYLOAD_VERSION), None),
+                        (new_appointment_notify_company, (appointment.id, PAYLOAD_VERSION), None),
+                        (new_appointment_add_to_calendar, (appointment.id, PAYLOAD_VERSION), None),
+                        (send_reminder_email, (appointment.id, PAYLOAD_VERSION), in_1_minute),
+                        (send_review_email, (appointment.id, PAYLOAD_VERSION), in_2_minutes),
+                    ])
+                    if idempotency_key:
+                        store_response(idempotency_key, data, status.HTTP_201_CREATED)
+            except (SlotUnavailable, IntegrityError) as e:
+                # A concurrent retry with the same key may have booked the slot first
+                stored_response = get_stored_response(idempotency_key)
+                if stored_response is not None:
+                    return stored_response
+                if isinstance(e, IntegrityError):
+                    raise
+                return Response({'time': ['La hora seleccionada ya no está disponible.']},
+                                status=status.HTTP_409_CONFLICT)
             return Response(data, status=status.HTTP_201_CREATED)
         errors = {}
 
@@ -266,6 +338,120 @@ class NewAppointmentView(APIView):
         return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class NewAppointmentSeriesView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request):
+        idempotency_key = get_idempotency_key(request, 'new_appointment_series')
+        if idempotency_key and len(idempotency_key.key) > 255:
+            return Response({'idempotency_key': ['La llave de idempotencia no puede superar 255 caracteres.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        stored_response = get_stored_response(idempotency_key)
+        if stored_response is not None:
+            return stored_response
+
+        start, errors = parse_booking_start(request.data)
+        if not request.data.get('rule'):
+            errors['rule'] = ['Este campo es requerido.']
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            schedule = get_schedule_template(int(request.data['service']))
+        except (Service.DoesNotExist, ValueError):
+            return Response({'service': ['El servicio seleccionado es inválido.']}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            occurrences = expand_rule(request.data['rule'], start)
+        except InvalidRule:
+            return Response({'rule': [f'La regla de recurrencia es inválida o supera {MAX_SERIES_OCCURRENCES} citas.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        appointment_data = request.data.copy()
+        appointment_data['start'] = start
+        appointment_data['end'] = start + schedule.duration
+        appointment_serializer = BookingAppointmentSerializer(data=appointment_data)
+        customer_serializer = get_customer_serializer(request.data)
+        if customer_serializer is None:
+            return Response({'citizen_id': ['El número de cédula debe ser numérico.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        valid_appointment = appointment_serializer.is_valid()
+        valid_customer = customer_serializer.is_valid()
+        if not (valid_appointment and valid_customer):
+            errors.update(appointment_serializer.errors)
+            errors.update(customer_serializer.errors)
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        validated_data = appointment_serializer.validated_data
+        try:
+            with transaction.atomic():
+                lock_professional(validated_data['professional'].pk)
+                results = check_occurrences(validated_data['professional'].pk, schedule, occurrences)
+                occurrences_data = [
+                    {
+                        'start': occurrence_start,
+                        'status': 'conflict' if reason else 'available',
+                        'reason': reason,
+                        'message': CONFLICT_MESSAGES.get(reason),
+                    }
+                    for occurrence_start, reason in results
+                ]
+                if any(reason for _, reason in results):
+                    # A concurrent retry with the same key may have booked the series first
+                    stored_response = get_stored_response(idempotency_key)
+                    if stored_response is not None:
+                        return stored_response
+                    return Response({'occurrences': occurrences_data}, status=status.HTTP_409_CONFLICT)
+
+                customer = customer_serializer.save()
+                series = AppointmentSeries.objects.create(rule=request.data['rule'], customer=customer)
+                appointments = [
+                    Appointment(
+                        location=validated_data['location'],
+                        service=validated_data['service'],
+                        professional=validated_data['professional'],
+                        observations=validated_data.get('observations', ''),
+                        customer=customer,
+                        series=series,
+                        start=occurrence_start,
+                        end=occurrence_start + schedule.duration,
+                    )
+                    for occurrence_start, _ in results
+                ]
+                # bulk_create skips save(), which fills the search document
+                for appointment in appointments:
+                    appointment.search_document = appointment.get_search_document()
+                appointments = Appointment.objects.bulk_create(appointments)
+                refresh_created_appointments(appointments)
+                for occurrence in occurrences_data:
+                    occurrence['status'] = 'created'
+                data = {
+                    'customer': customer_serializer.data,
+                    'series': {'id': series.id, 'rule': series.rule},
+                    'appointments': AppointmentSerializer(appointments, many=True).data,
+                    'occurrences': occurrences_data,
+                }
+                # One summary email for the series, and a calendar event and a reminder per occurrence
+                in_1_minute = timezone.now() + timezone.timedelta(minutes=1)
+                calls = [(new_appointment_series_notify, (series.id,), None)]
+                for appointment in appointments:
+                    calls += [
+                        (new_appointment_add_to_calendar, (appointment.id, PAYLOAD_VERSION), None),
+                        (send_reminder_email, (appointment.id, PAYLOAD_VERSION),
+                         max(appointment.start - SERIES_REMINDER_LEAD_TIME, in_1_minute)),
+                    ]
+                enqueue_many(calls)
+                if idempotency_key:
+                    store_response(idempotency_key, data, status.HTTP_201_CREATED)
+        except IntegrityError:
+            # The key was stored by a concurrent retry that committed first
+            stored_response = get_stored_response(idempotency_key)
+            if stored_response is not None:
+                return stored_response
+            raise
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
 class GetPlansInfo(APIView):
     permission_classes = [permissions.AllowAny]
     def get(self, request):
@@ -312,92 +498,31 @@ class StatsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, company_id):
-        start = timezone.now()
-        company = Company.objects.get(pk=company_id)
-        stats = {}
-
-        appointments = Appointment.objects.filter(service__company=company)
-        services = Service.objects.filter(company=company).values_list('name', flat=True)
-        professionals = Professional.objects.filter(company=company).values_list('name', flat=True)
-        dates = appointments.values_list('start__date', flat=True).distinct().order_by('start__date')
-
-        # Precompute counts and sums
-        appointments_per_service_per_date = appointments.values('start__date', 'service__name').annotate(
-            count=Count('id'))
-        revenue_per_service_per_date = appointments.values('start__date', 'service__name').annotate(
-            revenue=Sum('service__price'))
-        appointments_per_professional_per_date = appointments.values('start__date', 'professional__name').annotate(
-            count=Count('id'))
-
-        # Appointments by service by date
-        stats['appointments_per_service_per_date'] = [["Date"] + list(services)]
-        for date in dates:
-            row = [date]
-            for service in services:
-                count = next((item['count'] for item in appointments_per_service_per_date if
-                              item['start__date'] == date and item['service__name'] == service), 0)
-                row.append(count)
-            stats['appointments_per_service_per_date'].append(row)
-
-        # Appointments by service
-        stats['appointments_per_service'] = [["Service", "Count"]]
-        for service in services:
-            count = appointments.filter(service__name=service).count()
-            stats['appointments_per_service'].append([service, count])
-
-        # Revenue by service
-        stats['revenue_per_service_per_date'] = [["Date"] + list(services)]
-        for date in dates:
-            row = [date]
-            for service in services:
-                revenue = next((item['revenue'] for item in revenue_per_service_per_date if
-                                item['start__date'] == date and item['service__name'] == service), 1_000_000)
-                row.append(revenue)
-            stats['revenue_per_service_per_date'].append(row)
-
-        # Appointments by professional
-        stats['appointments_per_professional_per_date'] = [["Date"] + list(professionals)]
-        for date in dates:
-            row = [date]
-            for professional in professionals:
-                count = next((item['count'] for item in appointments_per_professional_per_date if
-                              item['start__date'] == date and item['professional__name'] == professional), 0)
-                row.append(count)
-            stats['appointments_per_professional_per_date'].append(row)
-
-        # Revenue this month
-        stats['revenue_this_month'] = (
-                appointments.filter(start__month=timezone.now().month)
-                .aggregate(Sum('service__price'))['service__price__sum'] or 1_000_000
-        )
+        errors = {}
+        dates = {}
+        for param in ['from', 'to']:
+            if param not in request.query_params:
+                continue
+            try:
+                dates[param] = datetime.strptime(request.query_params[param], '%Y-%m-%d').date()
+            except ValueError:
+                errors[param] = ['La fecha seleccionada es inválida.']
+        if not errors and 'from' in dates and 'to' in dates and dates['to'] < dates['from']:
+            errors['to'] = ['La fecha final debe ser mayor o igual a la fecha inicial.']
+        granularity = request.query_params.get('granularity', 'day')
+        if granularity not in GRANULARITIES:
+            errors['granularity'] = [f'Seleccione una opción válida: {", ".join(GRANULARITIES)}.']
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        # Appointments this month
-        appointments_this_month = appointments.filter(start__month=timezone.now().month)
-        stats['appointments_this_month'] = appointments_this_month.count()
-
-        # Customers this month
-        # Get appointments from before this month
-        appointments_before_this_month = appointments.filter(start__lt=timezone.now().replace(day=1))
-        old_customers = []
-        for appointment in appointments_before_this_month:
-            if appointment.customer not in old_customers:
-                old_customers.append(appointment.customer)
-        new_customers = []
-        for appointment in appointments_this_month:
-            if appointment.customer not in old_customers and appointment.customer not in new_customers:
-                new_customers.append(appointment.customer)
-
-        stats['new_customers_this_month'] = len(new_customers)
-        customers = old_customers + new_customers
-        # Totals
-        stats['total_revenue'] = appointments.aggregate(Sum('service__price'))['service__price__sum'] or 0
-        stats['total_appointments'] = appointments.count()
-        stats['total_customers'] = len(customers)
-
-        end = timezone.now()
-        delta_ms = (end - start).total_seconds() * 1000
-        print(f"Execution time: {delta_ms}")
-        return Response(stats)
+        params = (dates.get('from'), dates.get('to'), granularity)
+        key = stats_cache_key(company_id, *params)
+        # The key changes whenever the figures can, so it doubles as the ETag and a 304 needs no query
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(get_cached_company_stats(key, company_id, *params), headers={'ETag': etag})
 
 
 class AvailableTimesView(APIView):
@@ -405,30 +530,130 @@ class AvailableTimesView(APIView):
         professional = Professional.objects.get(pk=professional_id)
         service = Service.objects.get(pk=service_id)
         date_obj = datetime.strptime(date, '%Y-%m-%d').date()
-        busy_times = professional.get_busy_times(date_obj)
-        weekday = date_obj.weekday()
-        timeframes = service.timeframe_set.filter(weekday__id=weekday)
-        available_times = []
         # If date is today or less, return empty list
         if date_obj <= timezone.now().date():
-            return Response(available_times)
-        print(f"Finding available times for {professional} on {date} with {service}")
-        print(f"Busy times: {busy_times}")
-        for timeframe in timeframes:
-            print(f"Checking timeframe: {timeframe}")
-            current_time = timeframe.start_time
-            while current_time < timeframe.end_time:
-                print(f"Current time: {current_time}")
-                valid_time = True
-                for busy_time_start, busy_time_end in busy_times:
-                    if busy_time_start <= current_time < busy_time_end:
-                        valid_time = False
-                        current_time = (dt.datetime.combine(dt.date(1, 1, 1), current_time) + service.duration + service.time_between_appointments).time()
-                        print(f"Busy time: {busy_time_start} - {busy_time_end}")
-                        break
-                if valid_time:
-                    print(f"Valid time, appending...")
-                    available_times.append(current_time)
-                    current_time = (dt.datetime.combine(dt.date(1, 1, 1), current_time) + service.duration + service.time_between_appointments).time()
-        output = [{"id": name, "name": name} for idx,name in enumerate(available_times)]
+            return Response([])
+        available_times = get_cached_available_times(professional, service, date_obj)
+        output = [{"id": time, "name": time} for time in available_times]
+        return Response(output)
+
+
+class AvailableTimesRangeView(APIView):
+    max_days = 62
+
+    def get(self, request, professional_id, service_id):
+        errors = {}
+        dates = {}
+        for param in ['from', 'to']:
+            try:
+                dates[param] = datetime.strptime(request.query_params[param], '%Y-%m-%d').date()
+            except KeyError:
+                errors[param] = ['Este campo es requerido.']
+            except ValueError:
+                errors[param] = ['La fecha seleccionada es inválida.']
+        if not errors and dates['to'] < dates['from']:
+            errors['to'] = ['La fecha final debe ser mayor o igual a la fecha inicial.']
+        if not errors and (dates['to'] - dates['from']).days >= self.max_days:
+            errors['to'] = [f'El rango no puede superar {self.max_days} días.']
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        professional = Professional.objects.get(pk=professional_id)
+        service = Service.objects.get(pk=service_id)
+        # Dates up to today are never bookable
+        from_date = max(dates['from'], timezone.now().date() + dt.timedelta(days=1))
+        available_times = {}
+        if from_date <= dates['to']:
+            available_times = get_available_times_range(professional, service, from_date, dates['to'])
+
+        counts_only = request.query_params.get('counts', False) == 'true'
+        output = {}
+        date = dates['from']
+        while date <= dates['to']:
+            times = available_times.get(date, [])
+            output[date.isoformat()] = len(times) if counts_only else [{"id": time, "name": time} for time in times]
+            date += dt.timedelta(days=1)
+        return Response(output)
+
+
+def parse_id_params(query_params, names) -> tuple:
+    # Optional integer id filters, as {name: id or None} and the errors of the invalid ones
+    ids = {}
+    errors = {}
+    for name in names:
+        value = query_params.get(name)
+        if not value:
+            ids[name] = None
+        elif value.isdigit():
+            ids[name] = int(value)
+        else:
+            errors[name] = ['Introduzca un número entero válido.']
+    return ids, errors
+
+
+class ServiceAvailableTimesView(APIView):
+    def get(self, request, service_id, date):
+        ids, errors = parse_id_params(request.query_params, ['location'])
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        service = Service.objects.get(pk=service_id)
+        date_obj = datetime.strptime(date, '%Y-%m-%d').date()
+        # If date is today or less, return empty list
+        if date_obj <= timezone.now().date():
+            return Response([])
+        available_times = get_service_available_times(service, date_obj, location=ids['location'])
+        output = [
+            {"id": time, "name": time, "professional": professional.id, "professional_name": professional.name}
+            for time, professional in available_times
+        ]
         return Response(output)
+
+
+class NextAvailableView(APIView):
+    default_horizon = 90
+    max_horizon = 365
+
+    def get(self, request, service_id):
+        ids, errors = parse_id_params(request.query_params, ['professional', 'location'])
+        tomorrow = timezone.now().date() + dt.timedelta(days=1)
+        from_date = tomorrow
+        if request.query_params.get('from'):
+            try:
+                from_date = max(datetime.strptime(request.query_params['from'], '%Y-%m-%d').date(), tomorrow)
+            except ValueError:
+                errors['from'] = ['La fecha seleccionada es inválida.']
+        try:
+            horizon = int(request.query_params.get('horizon', self.default_horizon))
+            if not 1 <= horizon <= self.max_horizon:
+                raise ValueError
+        except ValueError:
+            errors['horizon'] = [f'El horizonte debe ser un número de días entre 1 y {self.max_horizon}.']
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        service = Service.objects.get(pk=service_id)
+        next_available = find_next_available(
+            service, from_date, horizon,
+            professional=ids['professional'], location=ids['location'],
+        )
+        if next_available is None:
+            return Response({'detail': 'No hay horarios disponibles en el rango seleccionado.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        date, time, professional = next_available
+        return Response({
+            "date": date,
+            "time": time,
+            "professional": professional.id,
+            "professional_name": professional.name,
+        })
+
+
+class CacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'availability': availability_counter.stats(),
+            'stats': stats_counter.stats(),
+            'catalog': catalog_counter.stats(),
+        })